@@ -0,0 +1,212 @@
+import io
+import json
+import time
+import argparse
+import platform
+import datetime
+import contextlib
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from src.synthetic import synthetic_fleet
+from src.pricing import get_all_costs
+from src.utils.periodicity_functions import keep_n_last_days, n_last_days_matrix, \
+    get_most_significant_periods_acf_batch, get_most_significant_periods_pacf_batch, get_most_significant_period_batch
+from src.utils.power_emission_functions import emission_table
+
+
+N_LAST_DAYS = 95
+METRIC = "value_max"
+
+
+def _keep_n_last_days(tables, max_clean_items):
+    item_trend = tables["item_trend"].copy()
+    return lambda: keep_n_last_days(item_trend, N_LAST_DAYS, METRIC)
+
+
+def _acf_pacf(tables, max_clean_items):
+    df_n_last_days = keep_n_last_days(tables["item_trend"].copy(), N_LAST_DAYS, METRIC)
+
+    def run():
+        _, matrix = n_last_days_matrix(df_n_last_days, N_LAST_DAYS, METRIC)
+        acf_lags, acf_coefs = get_most_significant_periods_acf_batch(matrix, 3, 3)
+        pacf_lags, pacf_coefs = get_most_significant_periods_pacf_batch(matrix, 3, 3)
+        return get_most_significant_period_batch(acf_lags, acf_coefs, pacf_lags, pacf_coefs, 0.6, 0.5)
+    return run
+
+
+def _clean_multiple(tables, max_clean_items):
+    from src.seasonality import clean_multiple
+
+    # Prophet fits are slow : only a sample of the seasonal items is cleaned
+    df_periods = tables["itemid_and_periods"].dropna(subset=["period1"]).head(max_clean_items)
+    item_trend = tables["item_trend"][tables["item_trend"].itemid.isin(df_periods.itemid)].copy()
+    return lambda: clean_multiple(item_trend, df_periods)
+
+
+def _cleaning_data_final_table(tables, max_clean_items):
+    args = [tables[name].copy() for name in ["cockpit", "tmp_hosts_zabbix", "item_trend", "item_info"]]
+    return lambda: emission_table(*args)
+
+
+def _get_all_costs(tables, max_clean_items):
+    cockpit, mycloud, item_trend = tables["cockpit"], tables["mycloud"], tables["item_trend"].copy()
+    return lambda: get_all_costs(cockpit, mycloud, item_trend)
+
+
+def _format_output(tables, max_clean_items):
+    from src.seasonality import format_output
+
+    # cleaned time-series : the trend itself, with its bounds as forecast
+    item_trend = tables["item_trend"]
+    ts = pd.DataFrame({"ds": pd.to_datetime(item_trend.clock), "y": item_trend.value_max,
+        "yhat_lower": item_trend.value_min, "yhat": item_trend.value_avg, "yhat_upper": item_trend.value_max,
+        "itemid": item_trend.itemid})
+    zabbix = tables["tmp_hosts_zabbix"].assign(host=tables["tmp_hosts_zabbix"].host.str.upper())
+    return lambda: format_output(ts, tables["item_info"].drop(columns=["item_type"]), zabbix, tables["cockpit"], tables["mycloud"])
+
+
+# Stages of the pipeline : each one prepares its inputs (not measured) and returns the measured call
+STAGES = {
+    "keep_n_last_days": _keep_n_last_days,
+    "acf_pacf": _acf_pacf,
+    "clean_multiple": _clean_multiple,
+    "cleaning_data+final_table": _cleaning_data_final_table,
+    "get_all_costs": _get_all_costs,
+    "format_output": _format_output,
+}
+
+
+def measure(prepare, tables, max_clean_items=20, memory=True):
+    '''
+    Time a stage, and measure its peak memory in a second run (tracemalloc slows the run down).
+
+    Args:
+        prepare : function = stage of STAGES
+        tables : dict(str: pd.DataFrame) = input tables (see synthetic.synthetic_fleet)
+        max_clean_items : int = number of items cleaned by clean_multiple
+        memory : bool = also measure the peak memory
+    Output:
+        seconds : float = duration of the stage
+        peak_mb : float = peak memory allocated by the stage, in MB (NaN if not measured)
+    '''
+    run = prepare(tables, max_clean_items)
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        run()
+        seconds = time.perf_counter() - start
+
+    peak_mb = np.nan
+    if memory:
+        run = prepare(tables, max_clean_items)
+        with contextlib.redirect_stdout(io.StringIO()):
+            tracemalloc.start()
+            try:
+                run()
+                peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+            finally:
+                tracemalloc.stop()
+
+    return seconds, peak_mb
+
+
+def run_benchmark(items=[100, 1000, 10000, 50000], n_days=365, stages=None, max_clean_items=20, memory=True, seed=0):
+    '''
+    Benchmark the stages of the pipeline on synthetic fleets of several sizes.
+
+    A stage that fails (ex: Prophet not installed for clean_multiple) is reported with its error,
+    and the other stages still run.
+
+    Args:
+        items : list(int) = numbers of items of the fleets (two items per server)
+        n_days : int = longest history of the items, in days
+        stages : list(str) = stages to run (default : all the STAGES)
+        max_clean_items : int = number of items cleaned by clean_multiple
+        memory : bool = also measure the peak memory of each stage
+        seed : int = seed of the synthetic fleets
+    Output:
+        results : pd.DataFrame([stage, n_items, n_rows, seconds, peak_mb, status, error]) = one row per stage and fleet size
+    '''
+    stages = list(STAGES) if stages is None else stages
+    results = []
+    for n_items in items:
+        tables = synthetic_fleet(n_servers=max(n_items // 2, 1), n_days=n_days, seed=seed)
+        for stage in stages:
+            record = {"stage": stage, "n_items": n_items, "n_rows": len(tables["item_trend"]),
+                "seconds": np.nan, "peak_mb": np.nan, "status": "ok", "error": None}
+            try:
+                record["seconds"], record["peak_mb"] = measure(STAGES[stage], tables, max_clean_items, memory)
+            except Exception as error:
+                record["status"], record["error"] = "failed", f"{type(error).__name__}: {error}"
+            print(f"{stage} ({n_items} items) : {record['seconds']:.2f}s, {record['peak_mb']:.0f}MB {record['error'] or ''}")
+            results.append(record)
+
+    return pd.DataFrame(results)
+
+
+def save_results(results, path, **params):
+    '''
+    Write benchmark results to a json file, with the versions and the parameters of the run.
+    '''
+    content = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+        "params": params,
+        "results": json.loads(results.to_json(orient="records")),
+    }
+    with open(path, "w") as file:
+        json.dump(content, file, indent=1)
+
+
+def load_results(path):
+    '''
+    Read the results of a json file written by save_results.
+    '''
+    with open(path) as file:
+        return pd.DataFrame(json.load(file)["results"])
+
+
+def compare(baseline, results, tolerance=0.25):
+    '''
+    Compare benchmark results to a baseline run : a stage regresses when it is slower or uses more memory
+    than the baseline by more than the tolerance.
+
+    Args:
+        baseline : pd.DataFrame = results of the baseline run (see load_results)
+        results : pd.DataFrame = results of the current run
+        tolerance : float = relative increase tolerated
+    Output:
+        comparison : pd.DataFrame([stage, n_items, seconds_ratio, peak_mb_ratio, regression]) = one row per stage and fleet size of both runs
+    '''
+    comparison = baseline.merge(results, on=["stage", "n_items"], suffixes=("_baseline", ""))
+    comparison["seconds_ratio"] = comparison.seconds / comparison.seconds_baseline
+    comparison["peak_mb_ratio"] = comparison.peak_mb / comparison.peak_mb_baseline
+    comparison["regression"] = (comparison.seconds_ratio > 1 + tolerance) | (comparison.peak_mb_ratio > 1 + tolerance)
+
+    return comparison[["stage", "n_items", "seconds_baseline", "seconds", "seconds_ratio",
+        "peak_mb_baseline", "peak_mb", "peak_mb_ratio", "regression"]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic fleets.")
+    parser.add_argument("--items", type=int, nargs="+", default=[100, 1000, 10000, 50000], help="numbers of items of the fleets")
+    parser.add_argument("--days", type=int, default=365, help="longest history of the items, in days")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=None, help="stages to run (default : all)")
+    parser.add_argument("--max-clean-items", type=int, default=20, help="number of items cleaned by clean_multiple")
+    parser.add_argument("--no-memory", action="store_true", help="do not measure the peak memory")
+    parser.add_argument("--output", default="benchmark.json", help="json file of the results")
+    parser.add_argument("--baseline", default=None, help="json file of a previous run to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="relative increase tolerated against the baseline")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.items, args.days, args.stages, args.max_clean_items, not args.no_memory)
+    save_results(results, args.output, items=args.items, days=args.days, max_clean_items=args.max_clean_items)
+    print(f"Results written to {args.output}.")
+
+    if args.baseline is not None:
+        comparison = compare(load_results(args.baseline), results, args.tolerance)
+        print(comparison.to_string(index=False))
+        if comparison.regression.any():
+            print(f"{comparison.regression.sum()} regression(s) against {args.baseline}.")
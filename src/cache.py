@@ -0,0 +1,102 @@
+import os
+import pickle
+import hashlib
+import tempfile
+
+import pandas as pd
+
+
+def make_key(*parts):
+    '''
+    Build a cache key from hashable parts (ids, parameters, dataframes).
+
+    Dataframes and series are hashed on their content, other parts on their repr.
+
+    Args:
+        parts : list = values identifying the cached object
+    Output:
+        key : str = hexadecimal digest of the parts
+    '''
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, (pd.DataFrame, pd.Series)):
+            digest.update(pd.util.hash_pandas_object(part, index=False).values.tobytes())
+            digest.update(repr(list(part.columns) if isinstance(part, pd.DataFrame) else part.name).encode())
+        else:
+            digest.update(repr(part).encode())
+        digest.update(b"|")
+    return digest.hexdigest()
+
+
+class DiskCache:
+    '''
+    Disk-backed cache of pickled objects, with a size-based least-recently-used eviction.
+
+    Each entry is one file named after its key. Reading an entry refreshes its modification time,
+    which is used as the recency of the entry. Writes are atomic, so that several processes
+    can share the same cache directory.
+
+    Args:
+        cache_dir : str = directory of the cache (created if needed)
+        max_size : int = maximum total size of the cache in bytes (None : no limit)
+    '''
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key, default=None):
+        '''
+        Load an entry of the cache, or default if the key is not cached.
+        '''
+        path = self._path(key)
+        try:
+            with open(path, "rb") as file:
+                value = pickle.load(file)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return default
+        os.utime(path)
+        return value
+
+    def put(self, key, value):
+        '''
+        Store an entry in the cache (replacing any previous entry with the same key).
+        '''
+        descriptor, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(descriptor, "wb") as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._path(key))
+
+    def size(self):
+        '''
+        Total size of the cache entries in bytes.
+        '''
+        return sum(entry.stat().st_size for entry in os.scandir(self.cache_dir) if entry.name.endswith(".pkl"))
+
+    def evict(self):
+        '''
+        Remove the least recently used entries until the cache fits in max_size.
+
+        Output:
+            n_evicted : int = number of removed entries
+        '''
+        if self.max_size is None:
+            return 0
+        entries = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in os.scandir(self.cache_dir) if entry.name.endswith(".pkl"))
+        total_size = sum(size for _, size, _ in entries)
+
+        n_evicted = 0
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            os.remove(path)
+            total_size -= size
+            n_evicted += 1
+        return n_evicted
@@ -0,0 +1,186 @@
+import numpy as np
+import pandas as pd
+
+from src.pricing import PriceTable
+from src.instrument import instrumented
+
+
+RESOURCES = ["cpu", "mem"]
+
+
+@instrumented()
+def demand_profiles(df, usage_column="value_max", date_column="clock", ram_column="ram", n_last_days=365):
+    '''
+    Daily cpu and memory demand of each server, as (days x resources) vectors.
+
+    The demand of a day is the capacity of the server times its usage : number of cpu for cpu items,
+    ram (GB) for mem items. Several items of the same resource on a server keep their highest usage.
+    Days without usage get the highest demand of the server, and a resource without any usage the
+    whole capacity of the server, so that the missing values never understate the demand.
+
+    Args:
+        df : pd.DataFrame([name_server, item_type, number_cpu, ram_column, date_column, usage_column]) = daily usage
+            of the items, ex: join_trend of the item trend (value_max) or format_output of the cleaned series (yhat_upper)
+        usage_column : str = usage percentage column
+        date_column : str = date column
+        ram_column : str = ram column, in GB (values above 1000 are considered in MB, as in pricing.fleet_servers)
+        n_last_days : int = number of last days kept (None : all days)
+    Output:
+        df_servers : pd.DataFrame([name_server, number_cpu, ram]) = configuration of each server (ram in GB)
+        dates : pd.DatetimeIndex = days of the profiles
+        demand : np.array(float) (n_servers x n_days x 2) = cpu (number of cpu) and memory (GB) demand of each server
+    '''
+    df = df[df["item_type"].isin(RESOURCES)]
+    ram = df[ram_column].astype(float)
+    if (ram > 1000).any():
+        ram = ram / 1000
+
+    df_servers = pd.DataFrame({"name_server": df["name_server"].to_numpy(), "number_cpu": df["number_cpu"].to_numpy(dtype=float),
+        "ram": ram.to_numpy()}).drop_duplicates("name_server").sort_values("name_server", ignore_index=True)
+
+    dates = pd.DatetimeIndex(np.unique(pd.to_datetime(df[date_column])))
+    if n_last_days is not None:
+        dates = dates[-n_last_days:]
+    df = df[pd.to_datetime(df[date_column]).isin(dates)]
+
+    # highest usage of each (server, day, resource)
+    server = df_servers.name_server.searchsorted(df["name_server"].to_numpy())
+    day = dates.searchsorted(pd.to_datetime(df[date_column]))
+    resource = (df["item_type"] == "mem").to_numpy().astype(int)
+    usage = np.full((len(df_servers), len(dates), len(RESOURCES)), np.nan)
+    values = df[usage_column].to_numpy(dtype=float)
+    order = np.argsort(values, kind="stable")  # the highest usage is written last
+    valid = order[~np.isnan(values[order])]
+    usage[server[valid], day[valid], resource[valid]] = values[valid]
+
+    capacity = df_servers[["number_cpu", "ram"]].to_numpy(dtype=float)[:, None, :]
+    demand = capacity * usage / 100
+
+    # missing days : highest demand of the server, missing resources : whole capacity
+    with np.errstate(invalid="ignore"):
+        peak = np.fmax.reduce(demand, axis=1, initial=-np.inf, where=~np.isnan(demand))
+    peak = np.where(np.isinf(peak), capacity[:, 0, :], peak)
+    demand = np.where(np.isnan(demand), peak[:, None, :], demand)
+
+    return df_servers, dates, demand
+
+
+def _catalogue_types(df_mycloud):
+    # cheapest price of each (CPU, RAM) configuration of the catalogue
+    types = df_mycloud.groupby(["CPU", "RAM"]).Price.min().reset_index()
+    return types.CPU.to_numpy(dtype=float), types.RAM.to_numpy(dtype=float), types.Price.to_numpy(dtype=float)
+
+
+@instrumented()
+def consolidate(df_servers, demand, df_mycloud, target_usage=0.8, price_table=None):
+    '''
+    Pack the servers' workloads on catalogue servers, day by day and resource by resource.
+
+    Workloads are packed by decreasing size (first fit decreasing) on hosts of the largest catalogue
+    configuration : a workload fits on a host when, on every day, the cpu and memory demands of the
+    host stay under target_usage of its capacity. Workloads whose peaks do not coincide can then share
+    a host. Each host is finally given the cheapest catalogue configuration covering its daily peaks.
+    Workloads larger than the largest configuration, and the workloads of a host costing more than
+    their current servers, keep their own server. Servers whose configuration is not in the catalogue
+    cannot be priced : they keep their own server, out of the prices before and after.
+
+    Args:
+        df_servers : pd.DataFrame([name_server, number_cpu, ram]) = configuration of each server (see demand_profiles)
+        demand : np.array(float) (n_servers x n_days x 2) = cpu and memory demand of each server (see demand_profiles)
+        df_mycloud : pandas.DataFrame(["RAM", "CPU", "Price"]) = table of the catalogue of prices of mycloud servors
+        target_usage : float = highest usage (proportion of the capacity) allowed on a host
+        price_table : PriceTable = compiled catalogue prices (default : built from df_mycloud)
+    Output:
+        df_assignment : pd.DataFrame([name_server, host]) = host of each server
+        df_hosts : pd.DataFrame([host, n_servers, peak_cpu, peak_ram, CPU, RAM, Price]) = configuration of each host
+        report : dict = number of servers and annual configuration price, before and after the consolidation,
+            and number of servers without catalogue configuration (n_unmatched_servers)
+    '''
+    if price_table is None:
+        price_table = PriceTable(df_mycloud)
+    type_cpu, type_ram, type_price = _catalogue_types(df_mycloud)
+
+    # hosts are opened with the largest configuration
+    largest = np.lexsort((type_ram, type_cpu))[-1]
+    limit = target_usage * np.array([type_cpu[largest], type_ram[largest]])
+
+    # current price of the servers (servers without catalogue configuration are not priced, as in annual_config_price)
+    server_prices, server_ram, matched = price_table.lookup(df_servers.ram.to_numpy(dtype=float), df_servers.number_cpu.to_numpy(dtype=float))
+    server_prices = np.where(matched, server_prices, np.nan)
+
+    n_servers = len(df_servers)
+    peak = demand.max(axis=1)
+    peak_day = demand.argmax(axis=1)
+    size = (peak / limit).sum(axis=1)
+    # unpriced servers are not packed : the prices before and after cover the same servers
+    unpacked = (peak > limit).any(axis=1) | ~matched
+
+    loads = np.zeros((n_servers, demand.shape[1], 2))
+    load_peak = np.zeros((n_servers, 2))
+    host = np.full(n_servers, -1)
+    n_hosts = 0
+
+    for server in np.argsort(-size, kind="stable"):
+        if unpacked[server]:
+            continue
+        open_loads, open_peaks = loads[:n_hosts], load_peak[:n_hosts]
+
+        # cheap bounds first : fits for sure under the sum of the peaks, cannot fit at the server's peak days
+        sure = (open_peaks + peak[server] <= limit).all(axis=1)
+        at_peak_days = open_loads[:, peak_day[server], [0, 1]] + peak[server]
+        possible = (at_peak_days <= limit).all(axis=1)
+
+        first_sure = np.argmax(sure) if sure.any() else n_hosts
+        candidates = np.flatnonzero(possible[:first_sure] & ~sure[:first_sure])
+        if len(candidates):
+            fits = ((open_loads[candidates] + demand[server]) <= limit).all(axis=(1, 2))
+            chosen = candidates[np.argmax(fits)] if fits.any() else first_sure
+        else:
+            chosen = first_sure
+
+        if chosen == n_hosts:
+            n_hosts += 1
+        loads[chosen] += demand[server]
+        load_peak[chosen] = loads[chosen].max(axis=0)
+        host[server] = chosen
+
+    # cheapest configuration covering the peaks of each host
+    host_peak = load_peak[:n_hosts]
+    covers = (target_usage * type_cpu >= host_peak[:, [0]] - 1e-9) & (target_usage * type_ram >= host_peak[:, [1]] - 1e-9)
+    host_type = np.argmin(np.where(covers, type_price, np.inf), axis=1)
+
+    # a host more expensive than its servers is not worth it : its servers keep their own configuration,
+    # as the unpacked workloads
+    packed = host >= 0
+    hosts_price = np.bincount(host[packed], weights=server_prices[packed], minlength=n_hosts)
+    reverted = type_price[host_type] >= hosts_price
+    own = unpacked | (packed & reverted[np.maximum(host, 0)])
+
+    kept = np.flatnonzero(~reverted)
+    host_id = np.full(n_hosts, -1)
+    host_id[kept] = np.arange(len(kept))
+    host = np.where(own, -1, host_id[np.maximum(host, 0)])
+    host[own] = len(kept) + np.arange(own.sum())
+
+    df_hosts = pd.concat([
+        pd.DataFrame({"host": np.arange(len(kept)),
+            "n_servers": np.bincount(host[~own], minlength=len(kept)),
+            "peak_cpu": host_peak[kept, 0], "peak_ram": host_peak[kept, 1],
+            "CPU": type_cpu[host_type[kept]], "RAM": type_ram[host_type[kept]], "Price": type_price[host_type[kept]]}),
+        pd.DataFrame({"host": host[own], "n_servers": 1,
+            "peak_cpu": peak[own, 0], "peak_ram": peak[own, 1],
+            "CPU": df_servers.number_cpu.to_numpy(dtype=float)[own],
+            "RAM": np.where(matched, server_ram, df_servers.ram.to_numpy(dtype=float))[own],
+            "Price": server_prices[own]})], ignore_index=True)
+
+    df_assignment = pd.DataFrame({"name_server": df_servers.name_server.to_numpy(), "host": host})
+
+    report = {
+        "n_servers_before": n_servers,
+        "n_servers_after": len(df_hosts),
+        "annual_config_price_before": np.nansum(server_prices),
+        "annual_config_price_after": df_hosts.Price.sum(),
+        "n_unmatched_servers": int((~matched).sum()),
+    }
+
+    return df_assignment, df_hosts, report
@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+
+from src.model import evaluate
+
+
+def design_matrix(t, periods, fourier_order=5):
+    '''
+    Harmonic regression features : intercept, linear trend and Fourier terms of each period.
+
+    Args:
+        t : np.array(float) (n_items x n_rows) = days since the first training day of each item
+        periods : np.array(float) (n_items x n_periods) = seasonality periods of each item, in days
+        fourier_order : int = number of Fourier terms (sin, cos) of each period
+    Output:
+        X : np.array(float) (n_items x n_rows x (2 + 2 * n_periods * fourier_order)) = design matrix of each item
+    '''
+    span = np.maximum(np.nanmax(t, axis=1, keepdims=True), 1)
+    order = np.arange(1, fourier_order + 1)
+    angle = 2 * np.pi * t[:, :, None, None] * order / periods[:, None, :, None]
+    fourier = np.stack([np.sin(angle), np.cos(angle)], axis=-1).reshape(t.shape + (-1,))
+    return np.concatenate([np.ones(t.shape + (1,)), (t / span)[..., None], fourier], axis=-1)
+
+
+def _fit_batch(t, y, fitted, periods, fourier_order, interval_width, cap):
+    # least squares on the fitted rows of each item (pseudo-inverse : the Fourier terms of a daily series
+    # above the Nyquist frequency are collinear), then bounds from the quantiles of the residuals
+    X = design_matrix(np.where(np.isnan(t), 0, t), periods, fourier_order)
+    coefs = np.linalg.pinv(X * fitted[..., None], rcond=1e-10) @ np.where(fitted, y, 0)[..., None]
+    yhat = (X @ coefs)[..., 0]
+
+    residuals = np.where(fitted, y - yhat, np.nan)
+    alpha = (1 - interval_width) / 2
+    lower, upper = np.nanquantile(residuals, [alpha, 1 - alpha], axis=1)
+
+    # saturation at the cap, as the logistic growth of the Prophet cleaning
+    clip = lambda values: np.clip(values, 0, cap)
+    return clip(yhat + lower[:, None]), clip(yhat), clip(yhat + upper[:, None])
+
+
+def harmonic_clean_batch(trains, periods, valids=None, fourier_order=5, interval_width=0.95, cap=100, batch_size=256):
+    '''
+    Model many time-series through their seasonalities only, in batched least squares.
+
+    Each item is regressed on an intercept, a linear trend and the Fourier terms of its periods
+    (as the seasonalities of the Prophet cleaning). Items with the same number of periods are padded
+    to the same length and solved together, batch_size items at a time. The uncertainty interval is
+    given by the quantiles of the training residuals of each item.
+
+    Args:
+        trains : list(pd.DataFrame([ds, y])) = training time-series of the items
+        periods : list(list(float)) = seasonality periods of each item (at least one)
+        valids : list(pd.DataFrame([ds, y])) = validation time-series of the items (predicted, not fitted)
+        fourier_order : int = number of Fourier terms of each period
+        interval_width : float = width of the uncertainty interval
+        cap : float = saturation of the series
+        batch_size : int = number of items solved together
+    Output:
+        preds : list(pd.DataFrame([ds, y, yhat_lower, yhat, yhat_upper])) = cleaned time-series of each item, on its
+            training and validation dates (None when the item has less than 2 values)
+        errors : list(str) = error message of each item (None if the cleaning succeeded)
+    '''
+    valids = [pd.DataFrame({"ds": [], "y": []})] * len(trains) if valids is None else valids
+    preds, errors = [None] * len(trains), [None] * len(trains)
+
+    items = []
+    for index, train in enumerate(trains):
+        if train.y.notna().sum() < 2:
+            errors[index] = "ValueError: Dataframe has less than 2 non-NaN rows."
+            continue
+        items.append(index)
+
+    # items with the same number of periods share the same design
+    n_periods = np.array([len(periods[index]) for index in items])
+    for size in np.unique(n_periods):
+        group = [index for index, n in zip(items, n_periods) if n == size]
+        for batch in [group[start:start + batch_size] for start in range(0, len(group), batch_size)]:
+            # dates and values of each item (training then validation rows), as numpy arrays
+            dates = [np.concatenate([pd.to_datetime(trains[index].ds).to_numpy(), pd.to_datetime(valids[index].ds).to_numpy()])
+                .astype("datetime64[ns]") for index in batch]
+            values = [np.concatenate([trains[index].y.to_numpy(dtype=float), valids[index].y.to_numpy(dtype=float)])
+                for index in batch]
+            n_rows = max(len(ds) for ds in dates)
+
+            t, y = np.full((len(batch), n_rows), np.nan), np.full((len(batch), n_rows), np.nan)
+            fitted = np.zeros((len(batch), n_rows), dtype=bool)
+            for row, (index, ds) in enumerate(zip(batch, dates)):
+                n_train = len(trains[index])
+                t[row, :len(ds)] = (ds - ds[:n_train].min()) / np.timedelta64(1, "D")
+                y[row, :len(ds)] = values[row]
+                fitted[row, :n_train] = True
+            fitted &= ~np.isnan(y)
+
+            lower, yhat, upper = _fit_batch(t, y, fitted, np.array([periods[index] for index in batch], dtype=float),
+                fourier_order, interval_width, cap)
+            for row, (index, ds) in enumerate(zip(batch, dates)):
+                n = len(ds)
+                preds[index] = pd.DataFrame({"ds": ds, "y": values[row],
+                    "yhat_lower": lower[row, :n], "yhat": yhat[row, :n], "yhat_upper": upper[row, :n]})
+
+    return preds, errors
+
+
+def harmonic_clean(train, valid, seasonality_periods=[7, 30.5], fourier_order=5):
+    '''
+    Model a time series through its seasonalities only, with a harmonic regression (same output as seasonality.clean).
+
+    Args:
+        train : pd.DataFrame = training set time-series
+        valid : pd.DataFrame = validation set time-series
+        seasonality_periods : list(float) = list of the periods of each seasonality
+        fourier_order : int = number of Fourier terms of each period
+    Output:
+        new_df : pd.DataFrame = cleaned time series
+    '''
+    (pred,), (error,) = harmonic_clean_batch([train], [seasonality_periods], [valid], fourier_order)
+    if error is not None:
+        raise ValueError(error.split(": ", 1)[1])
+
+    scores = evaluate(pred, valid)
+    print(f"Scores : {scores}.")
+    return pred
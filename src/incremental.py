@@ -0,0 +1,150 @@
+import pickle
+import pandas as pd
+
+from src.pricing import annual_config_price, saturation_counts, saturation_cost_from_counts, \
+    item_date_ranges, duration_mean_from_ranges
+from src.utils.periodicity_functions import keep_n_last_days, last_days_window
+from src.utils.power_emission_functions import emission_table, clock_aggregates, global_insights_table
+
+
+def build_state(df_item_trend, n_last_days=95, saturation_threshold=99,
+    cockpit=None, zabbix=None, item_info=None):
+    '''
+    Build the incremental state of the pipeline from the complete item_trend history.
+
+    The state holds everything the daily steps need, so that the next days can be ingested
+    without reading the history again :
+        - the rolling window of the n_last_days last occurrences of each item (periodicity),
+        - the number of fully and partially saturated days and the date range of each item (pricing),
+        - the running per-clock power and emission aggregates (emissions, only with the dimension tables).
+
+    Args:
+        df_item_trend : pd.DataFrame = table of the time series
+        n_last_days : int = length of the rolling window of each item
+        saturation_threshold : int = usage percentage from which we consider that the item is saturated
+        cockpit, zabbix, item_info : pd.DataFrame = dimension tables of the emissions (None : no emission state)
+    Output:
+        state : dict = incremental state
+    '''
+    df = df_item_trend.drop(columns=['Unnamed: 0'], errors='ignore').copy()
+    df["clock"] = pd.to_datetime(df.clock)
+
+    n_full_days, n_partial_days = saturation_counts(df, saturation_threshold)
+    state = {
+        "n_last_days": n_last_days,
+        "saturation_threshold": saturation_threshold,
+        "window": last_days_window(df, n_last_days).reset_index(drop=True),
+        "n_full_days": n_full_days,
+        "n_partial_days": n_partial_days,
+        "date_ranges": item_date_ranges(df),
+        "clock_aggregates": None,
+    }
+    if cockpit is not None:
+        state["clock_aggregates"] = clock_aggregates(emission_table(cockpit, zabbix, df, item_info))
+
+    return state
+
+
+def ingest(state, new_item_trend, cockpit=None, zabbix=None, item_info=None):
+    '''
+    Update the incremental state in place with newly extracted item_trend rows (typically one new day).
+
+    Rows whose clock is not after the last ingested clock of their item were already ingested
+    and are skipped, so overlapping extractions can be ingested safely. New rows must cover
+    complete days (cpu and mem items of a server are joined day by day for the emissions).
+
+    Args:
+        state : dict = incremental state (see build_state)
+        new_item_trend : pd.DataFrame = new rows of the table of the time series
+        cockpit, zabbix, item_info : pd.DataFrame = dimension tables (required if the state has emissions)
+    Output:
+        new_final : pd.DataFrame = emission rows of the new days, to append to the per-server emissions
+            (None when the state has no emissions)
+    '''
+    new = new_item_trend.drop(columns=['Unnamed: 0'], errors='ignore').copy()
+    new["clock"] = pd.to_datetime(new.clock)
+
+    # Keep only rows that were not ingested yet
+    last_clock = new.itemid.map(state["date_ranges"].max_date)
+    new = new[last_clock.isna() | (new.clock > last_clock)]
+
+    # Rolling windows : the last days of the history are the last days of (window + new rows)
+    state["window"] = last_days_window(pd.concat([state["window"], new], ignore_index=True),
+        state["n_last_days"]).reset_index(drop=True)
+
+    # Saturation counts and date ranges
+    n_full_days, n_partial_days = saturation_counts(new, state["saturation_threshold"])
+    state["n_full_days"] += n_full_days
+    state["n_partial_days"] += n_partial_days
+    date_ranges = pd.concat([state["date_ranges"], item_date_ranges(new)])
+    state["date_ranges"] = date_ranges.groupby(level=0).agg({"min_date": "min", "max_date": "max"})
+
+    # Per-clock emission aggregates
+    if state["clock_aggregates"] is None:
+        return None
+    new_final = emission_table(cockpit, zabbix, new, item_info)
+    state["clock_aggregates"] = pd.concat([state["clock_aggregates"], clock_aggregates(new_final)])\
+        .groupby(level=0).sum()
+
+    return new_final
+
+
+def periodicity_window(state, metric="value_max"):
+    '''
+    Last n_last_days days of each complete item, as keep_n_last_days on the full history.
+    '''
+    return keep_n_last_days(state["window"].copy(), state["n_last_days"], metric)
+
+
+def costs(state, df_cockpit, df_mycloud,
+    salary_year=40000, 
+    number_users=1, 
+    project_daily_value=0, 
+    average_saturation_duration = 0.1,
+    user_dependance = 0.6):
+    '''
+    Costs of the configuration from the incremental state, as get_all_costs on the full history
+    (with the saturation threshold of the state).
+
+    Outputs:
+        annual_config_price : int = annual price of all the servers 
+        total_saturation_cost : int = total cost of saturations over the ingested period
+        ts_average_duration : int = average duration covered by the time-series
+        total_annual_config_price : int = total annual price of the configuration (usage+saturation)
+    '''
+    annual_conf_price = annual_config_price(df_cockpit, df_mycloud)
+    total_sat_cost = saturation_cost_from_counts(state["n_full_days"],
+        state["n_partial_days"],
+        salary_year, 
+        number_users, 
+        project_daily_value, 
+        average_saturation_duration,
+        user_dependance)
+    ts_average_duration = duration_mean_from_ranges(state["date_ranges"])
+
+    total_annual_config_price = total_sat_cost/ts_average_duration + annual_conf_price
+
+    return annual_conf_price, total_sat_cost, ts_average_duration, total_annual_config_price
+
+
+def global_insights(state):
+    '''
+    Global power consumption and emission per clock, as in power_emission.py on the full history.
+    '''
+    return global_insights_table(state["clock_aggregates"])
+
+
+def save_state(state, path):
+    '''
+    Save the incremental state to disk.
+    '''
+    with open(path, "wb") as file:
+        pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_state(path):
+    '''
+    Load an incremental state saved with save_state.
+    '''
+    with open(path, "rb") as file:
+        return pickle.load(file)
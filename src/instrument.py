@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import time
+import signal
+import datetime
+import functools
+import threading
+import contextlib
+from collections import Counter
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows : peak RSS is not reported
+    resource = None
+
+
+# Instrumentation switch, profiled stages and report path, from the environment :
+# PIPELINE_INSTRUMENT=1, PIPELINE_PROFILE=clean_multiple,get_all_costs (or "all"), PIPELINE_REPORT=report.json
+_CONFIG = {
+    "enabled": os.environ.get("PIPELINE_INSTRUMENT", "0") not in ("", "0"),
+    "profile": set(filter(None, os.environ.get("PIPELINE_PROFILE", "").split(","))),
+    "profile_interval": 0.005,
+    "report_path": os.environ.get("PIPELINE_REPORT"),
+}
+_RECORDS = {"stages": [], "items": [], "profiles": dict()}
+_STACK = threading.local()
+
+
+def configure(enabled=True, profile=None, profile_interval=0.005, report_path=None):
+    '''
+    Switch the instrumentation on or off.
+
+    Args:
+        enabled : bool = record the stages (when off, the instrumented functions run as is)
+        profile : list(str) = stages run under the sampling profiler ("all" : every stage)
+        profile_interval : float = sampling interval of the profiler, in seconds of cpu time
+        report_path : str = json file where write_report writes the report by default
+    '''
+    _CONFIG["enabled"] = enabled
+    _CONFIG["profile"] = set(profile or [])
+    _CONFIG["profile_interval"] = profile_interval
+    _CONFIG["report_path"] = report_path
+
+
+def is_enabled():
+    return _CONFIG["enabled"]
+
+
+def reset():
+    '''
+    Clear the recorded stages, items and profiles.
+    '''
+    _RECORDS["stages"].clear()
+    _RECORDS["items"].clear()
+    _RECORDS["profiles"].clear()
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+
+def _n_rows(value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    if isinstance(value, tuple):
+        return next((len(part) for part in value if isinstance(part, (pd.DataFrame, pd.Series))), None)
+    return None
+
+
+class SamplingProfiler:
+    '''
+    Statistical profiler : the stack of the main thread is sampled at a fixed interval of cpu time.
+
+    Sampling keeps the overhead low and independent from the number of function calls, unlike a
+    deterministic profiler. It relies on SIGPROF, so it only runs in the main thread of Unix systems.
+
+    Args:
+        interval : float = sampling interval, in seconds of cpu time
+    '''
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self.self_samples = Counter()
+        self.n_samples = 0
+
+    def _sample(self, signum, frame):
+        self.n_samples += 1
+        self_function = True
+        seen = set()
+        while frame is not None:
+            code = frame.f_code
+            function = (code.co_filename, code.co_firstlineno, code.co_name)
+            if self_function:
+                self.self_samples[function] += 1
+                self_function = False
+            # recursive functions count once per sample
+            if function not in seen:
+                self.samples[function] += 1
+                seen.add(function)
+            frame = frame.f_back
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def top(self, n=30):
+        '''
+        Functions with the most samples (cumulative : function or its callees running).
+
+        Output:
+            top : list(dict) = function, file, line, samples and self_samples of each function
+        '''
+        return [{"function": name, "file": filename, "line": line,
+                 "samples": samples, "self_samples": self.self_samples[(filename, line, name)]}
+                for (filename, line, name), samples in self.samples.most_common(n)]
+
+
+def _can_profile():
+    return hasattr(signal, "SIGPROF") and threading.current_thread() is threading.main_thread()
+
+
+@contextlib.contextmanager
+def stage(name, rows_in=None):
+    '''
+    Record a stage of the pipeline : wall time, cpu time, peak RSS of the process at the end of the stage,
+    rows in / out and error. Stages listed in the profile configuration run under the sampling profiler.
+    Nothing is recorded when the instrumentation is off.
+
+    Args:
+        name : str = name of the stage
+        rows_in : int = number of input rows
+    Output:
+        record : dict = record of the stage (rows_out can be set in the block), not kept when the instrumentation is off
+    '''
+    if not _CONFIG["enabled"]:
+        yield dict()
+        return
+
+    stack = _STACK.__dict__.setdefault("names", [])
+    record = {"stage": name, "parent": stack[-1] if stack else None, "rows_in": rows_in, "rows_out": None,
+        "error": None}
+
+    profiler = None
+    if (name in _CONFIG["profile"] or "all" in _CONFIG["profile"]) and _can_profile() and not _STACK.__dict__.get("profiling"):
+        profiler = SamplingProfiler(_CONFIG["profile_interval"])
+        _STACK.profiling = True
+        profiler.start()
+
+    stack.append(name)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    except BaseException as error:
+        record["error"] = f"{type(error).__name__}: {error}"
+        raise
+    finally:
+        record["wall_s"] = time.perf_counter() - wall
+        record["cpu_s"] = time.process_time() - cpu
+        record["peak_rss_mb"] = _peak_rss_mb()
+        stack.pop()
+        if profiler is not None:
+            profiler.stop()
+            _STACK.profiling = False
+            _RECORDS["profiles"].setdefault(name, []).append(
+                {"n_samples": profiler.n_samples, "interval": profiler.interval, "top": profiler.top()})
+        _RECORDS["stages"].append(record)
+
+
+def instrumented(name=None):
+    '''
+    Decorator recording each call of a function as a stage (see stage). The rows in are the length
+    of the first dataframe argument, the rows out the length of the returned dataframe (or of the
+    first dataframe of a returned tuple). When the instrumentation is off, the function is called directly.
+
+    Args:
+        name : str = name of the stage (default : name of the function)
+    '''
+    def decorator(function):
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _CONFIG["enabled"]:
+                return function(*args, **kwargs)
+            rows_in = next((len(arg) for arg in args if isinstance(arg, (pd.DataFrame, pd.Series))), None)
+            with stage(stage_name, rows_in) as record:
+                result = function(*args, **kwargs)
+                record["rows_out"] = _n_rows(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def record_item(stage_name, item_id, seconds, error=None, **details):
+    '''
+    Record the processing of one item in a stage (ex: Prophet fit time of an item in clean_multiple),
+    with optional details (ex: fit="warm").
+    '''
+    if _CONFIG["enabled"]:
+        _RECORDS["items"].append({"stage": stage_name, "itemid": int(item_id), "seconds": seconds, "error": error,
+            **details})
+
+
+def report():
+    '''
+    Report of the recorded stages, items and profiles.
+
+    Output:
+        report : dict = created (date), stages (one record per call), items (one record per processed item),
+            summary (total times and number of calls / failures per stage) and profiles (top functions of each profiled stage)
+    '''
+    stages = pd.DataFrame(_RECORDS["stages"], columns=["stage", "parent", "wall_s", "cpu_s", "peak_rss_mb",
+        "rows_in", "rows_out", "error"])
+    summary = stages.groupby("stage", sort=False).agg(calls=("stage", "size"), wall_s=("wall_s", "sum"),
+        cpu_s=("cpu_s", "sum"), peak_rss_mb=("peak_rss_mb", "max"), failures=("error", "count"))
+
+    return {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "stages": json.loads(stages.to_json(orient="records")),
+        "items": list(_RECORDS["items"]),
+        "summary": json.loads(summary.reset_index().to_json(orient="records")),
+        "profiles": dict(_RECORDS["profiles"]),
+    }
+
+
+def write_report(path=None):
+    '''
+    Write the report as json (default path : PIPELINE_REPORT, or the report_path of configure).
+
+    Output:
+        path : str = path of the report (None if there is no path or the instrumentation is off)
+    '''
+    path = path or _CONFIG["report_path"]
+    if path is None or not _CONFIG["enabled"]:
+        return None
+    with open(path, "w") as file:
+        json.dump(report(), file, indent=1)
+    return path
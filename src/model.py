@@ -1,3 +1,7 @@
+import math
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import numpy as np
 
@@ -23,7 +27,7 @@ def evaluate(pred, valid):
     return {'RMSE': rmse, 'MAPE': mape}
 
 
-def forecast(model, train, valid):
+def forecast(model, train, valid, init=None):
     """Fits a Prophet model to training data and makes forecasts on validation data.
 
     Parameters
@@ -34,14 +38,279 @@ def forecast(model, train, valid):
         Training data, containing at least a date column (ds) and a target column (y).
     valid : pd.DataFrame
         Validation data, containing at least a date column (ds) and a target column (y).
+    init : dict
+        Initial values of the fit (see fitted_params), to warm-start it from a previous fit (None : cold start).
 
     Returns
     -------
     pd.DataFrame
         Dataframe containing forecasts and ground truth on both training and validation data.
     """
-    model.fit(train)
+    if init is None:
+        model.fit(train)
+    else:
+        model.fit(train, init=init)
     full_df = pd.concat([train, valid], axis=0)
     pred = model.predict(full_df)
     pred['y'] = np.array(full_df['y'])
-    return pred
\ No newline at end of file
+    return pred
+
+
+def fitted_params(model):
+    """Extracts the fitted parameters of a Prophet model, as initial values of a later fit.
+
+    Parameters
+    ----------
+    model : Prophet
+        Fitted Prophet model.
+
+    Returns
+    -------
+    dict
+        Growth rate (k), offset (m), changepoint deltas (delta), seasonality coefficients (beta) and noise (sigma_obs).
+    """
+    params = {name: float(np.ravel(model.params[name])[0]) for name in ['k', 'm', 'sigma_obs']}
+    params.update({name: np.ravel(model.params[name]).tolist() for name in ['delta', 'beta']})
+    return params
+
+
+def param_grid(grid):
+    """Lists the parameter combinations of a grid.
+
+    Parameters
+    ----------
+    grid : dict
+        Dictionary where keys are parameters names and values are lists of param values to be tested.
+
+    Returns
+    -------
+    list
+        One dictionary of parameters per combination.
+    """
+    return [dict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
+
+
+def time_folds(df, horizon=30, n_folds=3, train_days=None):
+    """Splits a time series into rolling-origin folds, the last one ending with the series.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Time series, containing at least a date column (ds) and a target column (y), one row per day.
+    horizon : int
+        Number of days in the validation set of each fold.
+    n_folds : int
+        Number of folds, each one shifted by horizon days from the next one.
+    train_days : int
+        Number of days in the training set of each fold (None : all the days before the fold).
+
+    Returns
+    -------
+    list
+        (train, valid) dataframes of each fold, with at least 2 training days.
+    """
+    df = df.sort_values("ds", ignore_index=True)
+    folds = []
+    for fold in range(n_folds, 0, -1):
+        cutoff = len(df) - fold * horizon
+        start = 0 if train_days is None else max(cutoff - int(train_days), 0)
+        if cutoff - start >= 2:
+            folds.append((df.iloc[start:cutoff], df.iloc[cutoff:cutoff + horizon]))
+    return folds
+
+
+def _fit_score(params, train, valid, seasonality_periods=(), fourier_order=5):
+    # Worker of the tuning : fits one candidate on one fold (failed fits score infinite, with their error)
+    from fbprophet import Prophet
+
+    try:
+        model = Prophet(**params)
+        for period in seasonality_periods:
+            model.add_seasonality(period=period, name=f'seasonality_{period}', fourier_order=fourier_order)
+        if params.get("growth") == "logistic":
+            train, valid = train.assign(cap=100), valid.assign(cap=100)
+        scores = evaluate(forecast(model, train, valid), valid)
+        if not np.isfinite(scores['RMSE']):
+            raise ValueError(f"Non-finite RMSE on the validation set ({scores['RMSE']}).")
+        return {**scores, 'error': None}
+    except Exception as error:
+        return {'RMSE': np.inf, 'MAPE': np.inf, 'error': f"{type(error).__name__}: {error}"}
+
+
+def successive_halving(series, grid, base_params=None, seasonality_periods=None, horizon=30, n_folds=3,
+                       eta=3, min_train_days=60, n_jobs=1, metric='RMSE'):
+    """Tunes Prophet on one or several time series by successive halving.
+
+    All the candidates are first scored on short training windows, which are fast to fit. Only the best
+    1 / eta of them are kept for the next rung, whose windows are eta times longer, up to the full
+    history on the last rung. Each candidate is scored on the rolling-origin folds of every series,
+    and the fits of a rung run on a pool of processes. A failed fit scores infinite : the failures of each
+    rung are reported, and the tuning stops when every candidate of a rung failed.
+
+    Parameters
+    ----------
+    series : list
+        Time series to tune on (one item, or the items of a cluster), with a date column (ds) and a target column (y).
+    grid : dict
+        Dictionary where keys are parameters names and values are lists of param values to be tested.
+    base_params : dict
+        Parameters shared by all the candidates (ex: seasonality.clean_params()).
+    seasonality_periods : list
+        Periods of the seasonalities added to the model, for each series (None : no seasonality added).
+    horizon : int
+        Number of days in the validation set of each fold.
+    n_folds : int
+        Number of folds of each series.
+    eta : int
+        Proportion of the candidates dropped at each rung (1 - 1 / eta), and growth of the training windows.
+    min_train_days : int
+        Shortest training window : the first rung starts at min_train_days or more, and the number of rungs
+        is reduced to the windows between min_train_days and the full history.
+    n_jobs : int
+        Number of worker processes (1 : serial execution).
+    metric : str
+        Metric minimized (RMSE or MAPE), averaged over the folds of all the series.
+
+    Returns
+    -------
+    dict
+        Best parameters (base parameters included).
+    pd.DataFrame
+        Score of each candidate at each rung (rung, train_days, candidate, parameters, RMSE, MAPE,
+        number of failed fits n_failed and first error).
+
+    Raises
+    ------
+    ValueError
+        If every candidate of a rung failed to fit.
+    """
+    base_params = dict() if base_params is None else base_params
+    seasonality_periods = [()] * len(series) if seasonality_periods is None else seasonality_periods
+    candidates = param_grid(grid)
+
+    # Training windows of the rungs : eta times longer at each rung, the last one is the full history.
+    # Only the windows of at least min_train_days make a rung : on a short history, there are fewer rungs
+    # (and more candidates on the last one) rather than several rungs on the same window
+    history = max(len(df) for df in series) - horizon
+    n_rungs = int(math.floor(math.log(len(candidates), eta) + 1e-9)) + 1 if len(candidates) > 1 else 1
+    n_admissible = int(math.floor(math.log(history / min_train_days, eta) + 1e-9)) + 1 if history > min_train_days else 1
+    n_rungs = min(n_rungs, n_admissible)
+    windows = [int(history / eta ** (n_rungs - 1 - rung)) for rung in range(n_rungs - 1)] + [None]
+    # a window longer than the history of the shorter series gives them the same training sets as the next
+    # rung : rungs with the same training sets on every series are merged
+    evidence = [[len(train) for df in series for train, _ in time_folds(df, horizon, n_folds, train_days)]
+                for train_days in windows]
+    windows = [train_days for train_days, rung, next_rung in zip(windows, evidence, evidence[1:] + [None])
+               if rung != next_rung]
+
+    survivors = list(range(len(candidates)))
+    history_rows = []
+    executor = ProcessPoolExecutor(max_workers=n_jobs) if n_jobs > 1 else None
+    try:
+        for rung, train_days in enumerate(windows):
+            jobs = [(candidate, {**base_params, **candidates[candidate]}, train, valid, periods)
+                    for candidate in survivors
+                    for df, periods in zip(series, seasonality_periods)
+                    for train, valid in time_folds(df, horizon, n_folds, train_days)]
+            if executor is None:
+                scores = [_fit_score(params, train, valid, periods) for _, params, train, valid, periods in jobs]
+            else:
+                scores = list(executor.map(_fit_score, *zip(*[job[1:] for job in jobs])))
+
+            results = pd.DataFrame([{'candidate': job[0], **score} for job, score in zip(jobs, scores)])
+            rung_scores = results.groupby('candidate')[['RMSE', 'MAPE']].mean().reindex(survivors)
+            failures = results[results.error.notna()].groupby('candidate').error
+            rung_scores['n_failed'] = failures.size().reindex(survivors, fill_value=0)
+            rung_scores['error'] = failures.first().reindex(survivors)
+            # a candidate with a failed fit scores infinite (the grouped mean of infinite scores is NaN)
+            rung_scores[['RMSE', 'MAPE']] = rung_scores[['RMSE', 'MAPE']].where(rung_scores.n_failed == 0, np.inf)
+            for candidate, score in rung_scores.iterrows():
+                history_rows.append({'rung': rung, 'train_days': train_days, 'candidate': candidate,
+                                     **candidates[candidate], **score.to_dict()})
+
+            if rung_scores.n_failed.sum():
+                print(f"Rung {rung} : {rung_scores.n_failed.sum()} fit(s) failed out of {len(results)}, "
+                      f"for candidate(s) {rung_scores.index[rung_scores.n_failed > 0].tolist()} "
+                      f"({rung_scores.error.dropna().iloc[0]}).")
+            if not np.isfinite(rung_scores[metric]).any():
+                raise ValueError(f"Every candidate failed at rung {rung} ({rung_scores.error.dropna().iloc[0]}).")
+
+            # Best 1 / eta candidates go to the next rung
+            n_kept = max(1, math.ceil(len(survivors) / eta)) if rung < len(windows) - 1 else 1
+            survivors = list(rung_scores[metric].sort_values(kind='stable').index[:n_kept])
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return {**base_params, **candidates[survivors[0]]}, pd.DataFrame(history_rows)
+
+
+def period_clusters(df_periods):
+    """Groups the items sharing the same seasonality periods.
+
+    Parameters
+    ----------
+    df_periods : pd.DataFrame
+        Table listing the seasonality periods of each time-series (itemid, then one column per period).
+
+    Returns
+    -------
+    pd.DataFrame
+        Cluster of each item (itemid, cluster, periods).
+    """
+    periods = [tuple(sorted(period for period in row if str(period) != 'nan'))
+               for row in df_periods.drop(columns='itemid').itertuples(index=False)]
+    return pd.DataFrame({'itemid': df_periods.itemid.to_numpy(),
+                         'cluster': [' '.join(str(period) for period in item) or 'none' for item in periods],
+                         'periods': periods})
+
+
+def tune_clusters(item_trend, df_clusters, grid, base_params=None, n_items=5, seed=0, metric='RMSE', **halving_kwargs):
+    """Tunes Prophet once per cluster of items, on a sample of its items.
+
+    Tuning every item is out of reach on the whole fleet : the items of a cluster (ex: period_clusters)
+    share the parameters tuned by successive halving on n_items of them.
+
+    Parameters
+    ----------
+    item_trend : pd.DataFrame
+        Table of the time series (itemid, clock, value_max).
+    df_clusters : pd.DataFrame
+        Cluster of each item (itemid, cluster, and optionally the seasonality periods of each item).
+    grid : dict
+        Dictionary where keys are parameters names and values are lists of param values to be tested.
+    base_params : dict
+        Parameters shared by all the candidates.
+    n_items : int
+        Number of items of each cluster the tuning runs on.
+    seed : int
+        Seed of the sampling of the items.
+    metric : str
+        Metric minimized (RMSE or MAPE).
+    halving_kwargs : dict
+        Extra arguments passed to successive_halving (horizon, n_folds, eta, min_train_days, n_jobs).
+
+    Returns
+    -------
+    pd.DataFrame
+        Best parameters and score of each cluster (cluster, n_items, tuned_items, params, RMSE, MAPE).
+    pd.DataFrame
+        Score of each candidate at each rung, for each cluster.
+    """
+    samples = {item_id: sample for item_id, sample in item_trend[['itemid', 'clock', 'value_max']].groupby('itemid')}
+    rng = np.random.default_rng(seed)
+
+    best, histories = [], []
+    for cluster, items in df_clusters[df_clusters.itemid.isin(samples.keys())].groupby('cluster', sort=False):
+        tuned = items.iloc[np.sort(rng.permutation(len(items))[:n_items])]
+        series = [pd.DataFrame({'ds': pd.to_datetime(samples[item_id].clock), 'y': samples[item_id].value_max.to_numpy()})
+                  for item_id in tuned.itemid]
+        periods = list(tuned.periods) if 'periods' in tuned.columns else None
+
+        params, history = successive_halving(series, grid, base_params, periods, metric=metric, **halving_kwargs)
+        last_rung = history[history.rung == history.rung.max()].sort_values(metric).iloc[0]
+        best.append({'cluster': cluster, 'n_items': len(items), 'tuned_items': list(tuned.itemid), 'params': params,
+                     'RMSE': last_rung.RMSE, 'MAPE': last_rung.MAPE})
+        histories.append(history.assign(cluster=cluster))
+
+    return pd.DataFrame(best), pd.concat(histories, ignore_index=True) if histories else pd.DataFrame()
@@ -0,0 +1,438 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import pandas as pd
+
+from src.cache import DiskCache, make_key
+from src.storage import build_store, load_table, iter_months
+from src.instrument import stage, write_report
+from src.pricing import get_all_costs
+from src.sizing import saturation_usage, config_optim, config_optim_season
+from src.utils.periodicity_functions import keep_n_last_days, n_last_days_matrix, \
+    get_most_significant_periods_acf_batch, get_most_significant_periods_pacf_batch, get_most_significant_period_batch
+from src.utils.power_emission_functions import stream_emissions, global_insights_table
+
+
+# Bump when the code of a stage changes its artifact : every cached artifact is then recomputed
+PIPELINE_VERSION = 4
+
+TABLES = ["cockpit", "tmp_hosts_zabbix", "item_info", "item_trend", "mycloud"]
+
+# Parameters of the stages : they are part of the cache keys of the artifacts
+DEFAULT_PARAMS = {
+    "periodicity": {"n_last_days": 95, "metric": "value_max", "n_largest": 3, "remove_n_first_lags": 3,
+        "acf_threshold": 0.60, "pacf_threshold": 0.50},
+    "cleaning": {"engine": "prophet"},
+    "format_output": {},
+    "sizing": {"metric": "value_avg", "saturation_threshold": 99.9, "n_season_days": 30,
+        "threshold_min_cpu": 60, "threshold_max_cpu": 80, "threshold_min_ram": 70, "threshold_max_ram": 80},
+    "pricing": {"salary_year": 40000, "number_users": 1, "project_daily_value": 0, "saturation_threshold": 99,
+        "average_saturation_duration": 0.1, "user_dependance": 0.6},
+    "emissions": {},
+}
+
+
+def _periodicity(inputs, params, options):
+    # the last days of the items are part of the artifact (see get_periodicity.py)
+    df = keep_n_last_days(load_table(inputs["item_trend"]), params["n_last_days"], params["metric"])
+    itemids, matrix = n_last_days_matrix(df, params["n_last_days"], params["metric"])
+
+    acf_lags, acf_coefs = get_most_significant_periods_acf_batch(matrix, params["n_largest"], params["remove_n_first_lags"])
+    pacf_lags, pacf_coefs = get_most_significant_periods_pacf_batch(matrix, params["n_largest"], params["remove_n_first_lags"])
+    periods = get_most_significant_period_batch(acf_lags, acf_coefs, pacf_lags, pacf_coefs,
+        params["acf_threshold"], params["pacf_threshold"])
+
+    df_periods = pd.DataFrame({
+        "itemid": itemids,
+        "period1": periods,
+        "acf_autocorrelation": [list(zip(lags, coefs)) for lags, coefs in zip(acf_lags, acf_coefs)],
+        "pacf_autocorrelation": [list(zip(lags, coefs)) if not np.isnan(coefs).all() else np.NaN
+            for lags, coefs in zip(pacf_lags, pacf_coefs)]})
+    return {"periods": df_periods, "last_days": df}
+
+
+def _cleaning(inputs, params, options):
+    from src.seasonality import clean_multiple
+
+    # only the seasonal items are cleaned ; the Prophet fits of the items are cached between runs,
+    # so that a new day only warm-starts the refits
+    df_periods = inputs["periodicity"]["periods"]
+    df_periods = df_periods.loc[df_periods.period1.notna(), ["itemid", "period1"]].reset_index(drop=True)
+    item_trend = load_table(inputs["item_trend"], columns=["itemid", "clock", "value_max"], itemids=df_periods.itemid)
+    cache = DiskCache(os.path.join(options["cache_dir"], "items")) if params["engine"] == "prophet" else None
+
+    return clean_multiple(item_trend, df_periods, n_jobs=options["n_jobs"], cache=cache, engine=params["engine"],
+        warm_start=cache is not None)
+
+
+def _zabbix_hosts(cockpit, zabbix):
+    # server names are uppercase in cockpit : the zabbix hosts are joined in uppercase (as in stream_emissions)
+    zabbix = zabbix.assign(host=zabbix.host.str.upper())
+    if not cockpit.name_server.isin(zabbix.host).any():
+        raise ValueError("No server of cockpit matches a host of tmp_hosts_zabbix.")
+    return zabbix
+
+
+def _format_output(inputs, params, options):
+    from src.seasonality import format_output
+
+    return format_output(inputs["cleaning"], inputs["item_info"], _zabbix_hosts(inputs["cockpit"], inputs["tmp_hosts_zabbix"]),
+        inputs["cockpit"], inputs["mycloud"])
+
+
+def _sizing(inputs, params, options):
+    thresholds = {name: value for name, value in params.items() if name.startswith("threshold_")}
+
+    # non periodic items : one row per (server, item), sized on the usage weighted by the saturation streaks
+    servers = inputs["cockpit"][["name_server", "ram", "number_core", "number_cpu", "type_cpu"]]\
+        .merge(_zabbix_hosts(inputs["cockpit"], inputs["tmp_hosts_zabbix"]), left_on="name_server", right_on="host")\
+        .merge(inputs["item_info"].drop(columns=["item_type"], errors="ignore"), on="hostid")
+    item_trend = load_table(inputs["item_trend"], columns=["itemid", "clock", "item_type", params["metric"]])
+    servers = servers.merge(item_trend[["itemid", "item_type"]].drop_duplicates("itemid"), on="itemid").drop_duplicates()
+    servers = servers[servers.item_type != "citrix"]\
+        .merge(inputs["periodicity"]["periods"][["itemid", "period1"]], on="itemid")
+    servers["season"] = (servers.period1 > 0).astype(int)
+
+    usage = saturation_usage(item_trend, thresholds=[params["saturation_threshold"]], metric=params["metric"]).drop(columns=["threshold"])
+    df_global, counts_global = config_optim(servers.merge(usage, on="itemid"), **thresholds)
+
+    # periodic items : their last days, sized day by day on the cleaned time-series
+    df_periodic = inputs["format_output"].sort_values("ds", kind="stable").groupby("itemid").tail(params["n_season_days"])
+    df_periodic = df_periodic.assign(item_type=df_periodic.item_type.replace("mem_pused", "mem"))
+    df_periodic, counts_periodic = config_optim_season(df_periodic, **thresholds)
+
+    return {"global": df_global, "periodic": df_periodic, "counts_global": counts_global, "counts_periodic": counts_periodic}
+
+
+def _pricing(inputs, params, options):
+    annual_config_price, total_saturation_cost, ts_average_duration, total_annual_config_price = \
+        get_all_costs(inputs["cockpit"], inputs["mycloud"], load_table(inputs["item_trend"]), **params)
+    return {"annual_config_price": float(annual_config_price), "total_saturation_cost": float(total_saturation_cost),
+        "ts_average_duration": float(ts_average_duration), "total_annual_config_price": float(total_annual_config_price)}
+
+
+def _emissions(inputs, params, options):
+    # item_trend is read month by month from the store, and the emissions per server per day are written
+    # month by month next to the artifact (the artifact keeps the path of the file)
+    server_day = os.path.join(options["cache_dir"], "emissions", f"{options['key']}.csv")
+    os.makedirs(os.path.dirname(server_day), exist_ok=True)
+    aggregates_clock, aggregates_server = stream_emissions(inputs["cockpit"], inputs["tmp_hosts_zabbix"],
+        inputs["item_info"], iter_months(inputs["item_trend"], compact=True), output_path=server_day)
+    return {"global_insights": global_insights_table(aggregates_clock), "aggregates_server": aggregates_server,
+        "server_day": server_day}
+
+
+# Stages of the pipeline : their inputs (tables or stages) and the function computing their artifact
+STAGES = {
+    "periodicity": {"inputs": ["item_trend"], "run": _periodicity},
+    "cleaning": {"inputs": ["item_trend", "periodicity"], "run": _cleaning},
+    "format_output": {"inputs": ["cleaning", "item_info", "tmp_hosts_zabbix", "cockpit", "mycloud"], "run": _format_output},
+    "sizing": {"inputs": ["item_trend", "periodicity", "format_output", "cockpit", "tmp_hosts_zabbix", "item_info"], "run": _sizing},
+    "pricing": {"inputs": ["cockpit", "mycloud", "item_trend"], "run": _pricing},
+    "emissions": {"inputs": ["cockpit", "tmp_hosts_zabbix", "item_info", "item_trend"], "run": _emissions},
+}
+FINAL_STAGES = ["sizing", "pricing", "emissions"]
+
+
+def table_paths(data_dir="data", suffix="20221221", overrides=None):
+    '''
+    Paths of the extraction tables (ex: data/item_trend_20221221.csv, see synthetic.write_fleet).
+
+    Args:
+        data_dir : str = directory of the extraction files
+        suffix : str = extraction date of the file names
+        overrides : dict(str: str) = path of some tables, replacing the default ones
+    Output:
+        paths : dict(str: str) = path of each table
+    '''
+    paths = {name: os.path.join(data_dir, f"{name}_{suffix}.csv") for name in TABLES}
+    paths.update(overrides or dict())
+    return paths
+
+
+def _load(name, path, chunksize=None):
+    # item_trend is converted once into the columnar store (rebuilt when the csv changes), whose path
+    # is passed to the stages
+    if name == "item_trend":
+        return build_store(path, chunksize=chunksize)
+    return load_table(path)
+
+
+def _file_digest(path, cache=None):
+    # content digest of a file, memoized in the cache under its path, size and modification time
+    stat = os.stat(path)
+    key = make_key("digest", os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    digest = cache.get(key) if cache is not None else None
+    if digest is None:
+        hasher = hashlib.sha1()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                hasher.update(block)
+        digest = hasher.hexdigest()
+        if cache is not None:
+            cache.put(key, digest)
+    return digest
+
+
+def _fingerprint(path, cache=None):
+    # a table changes when the content of its file (or of the files of its store) changes
+    if os.path.isfile(path):
+        return [_file_digest(path, cache)]
+    files = sorted(os.path.join(root, file) for root, _, files in os.walk(path) for file in files)
+    return [(os.path.relpath(file, path), _file_digest(file, cache)) for file in files]
+
+
+def resolve_params(params=None):
+    '''
+    Parameters of each stage : the default ones, updated with params.
+
+    Args:
+        params : dict(str: dict) = parameters of some stages (ex: {"periodicity": {"n_last_days": 60}})
+    Output:
+        params : dict(str: dict) = parameters of every stage
+    '''
+    resolved = {name: dict(stage_params) for name, stage_params in DEFAULT_PARAMS.items()}
+    for name, stage_params in (params or dict()).items():
+        if name not in resolved:
+            raise ValueError(f"Unknown stage : {name}.")
+        unknown = set(stage_params) - set(resolved[name])
+        if unknown:
+            raise ValueError(f"Unknown parameters of {name} : {sorted(unknown)}.")
+        resolved[name].update(stage_params)
+    return resolved
+
+
+def plan(paths, targets=None, params=None, cache=None):
+    '''
+    Stages needed by the targets, in execution order, with the cache key of their artifact.
+
+    The key of a table is a digest of the content of its file, the key of a stage a hash of its parameters
+    and of the keys of its inputs : a stage is recomputed when its parameters or the content of any of its
+    upstream tables change (not when a file is only touched or copied). The digests are kept in the cache
+    under the size and modification time of the files : an unchanged file is not read again.
+
+    Args:
+        paths : dict(str: str) = path of each table (see table_paths)
+        targets : list(str) = stages to compute (default : the final stages, sizing, pricing and emissions)
+        params : dict(str: dict) = parameters of the stages (see resolve_params)
+        cache : DiskCache = cache of the file digests (None : the files are read at each call)
+    Output:
+        keys : dict(str: str) = cache key of each needed table and stage, in execution order
+    '''
+    params = resolve_params(params)
+    targets = FINAL_STAGES if targets is None else targets
+    unknown = set(targets) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown stages : {sorted(unknown)}.")
+
+    keys = dict()
+
+    def visit(name):
+        if name in keys:
+            return
+        if name in TABLES:
+            keys[name] = make_key("table", name, _fingerprint(paths[name], cache))
+            return
+        for input_name in STAGES[name]["inputs"]:
+            visit(input_name)
+        keys[name] = make_key(PIPELINE_VERSION, name, sorted(params[name].items()),
+            [keys[input_name] for input_name in STAGES[name]["inputs"]])
+
+    for target in targets:
+        visit(target)
+    return keys
+
+
+def run_pipeline(paths, targets=None, params=None, cache_dir=".pipeline_cache", max_workers=4, n_jobs=1, force=(),
+    chunksize=None):
+    '''
+    Run the stages needed by the targets, skipping the stages whose artifact is cached.
+
+    Each artifact is cached on disk under the key of its stage (see plan). Stages whose inputs are
+    available run concurrently on a pool of threads (ex: emissions and periodicity).
+
+    Args:
+        paths : dict(str: str) = path of each table (see table_paths)
+        targets : list(str) = stages to compute (default : the final stages, sizing, pricing and emissions)
+        params : dict(str: dict) = parameters of the stages (see resolve_params)
+        cache_dir : str = directory of the cached artifacts
+        max_workers : int = number of stages run concurrently (1 : serial execution, in the main thread)
+        n_jobs : int = number of worker processes of the seasonality cleaning
+        force : list(str) = stages recomputed even if they are cached
+        chunksize : int = number of csv rows converted at once into the item_trend store (default : the whole csv)
+    Output:
+        artifacts : dict(str: object) = artifact of each target
+        status : dict(str: str) = status of each needed stage ("cached" or "computed")
+    '''
+    params = resolve_params(params)
+    targets = FINAL_STAGES if targets is None else list(targets)
+    cache = DiskCache(cache_dir)
+    keys = plan(paths, targets, params, cache)
+    options = {"cache_dir": cache_dir, "n_jobs": n_jobs}
+
+    stages = [name for name in keys if name in STAGES]
+    to_run = [name for name in stages if name in force or keys[name] not in cache]
+    status = {name: "computed" if name in to_run else "cached" for name in stages}
+
+    # artifacts are loaded (tables) or read from the cache when a stage needs them
+    artifacts, locks = dict(), {name: threading.Lock() for name in keys}
+
+    def get(name):
+        with locks[name]:
+            if name not in artifacts:
+                artifacts[name] = _load(name, paths[name], chunksize) if name in TABLES else cache.get(keys[name])
+            return artifacts[name]
+
+    def run(name):
+        start = time.perf_counter()
+        with stage(f"pipeline.{name}"):
+            inputs = {input_name: get(input_name) for input_name in STAGES[name]["inputs"]}
+            artifact = STAGES[name]["run"](inputs, params[name], {**options, "key": keys[name]})
+        cache.put(keys[name], artifact)
+        artifacts[name] = artifact
+        print(f"{name} : computed in {time.perf_counter() - start:.1f}s.")
+
+    for name in stages:
+        if status[name] == "cached":
+            print(f"{name} : cached.")
+
+    done = {name for name in stages if status[name] == "cached"}
+    pending = list(to_run)
+    if max_workers == 1:
+        for name in pending:
+            run(name)
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            running = dict()
+            while pending or running:
+                # start the stages whose input stages are done
+                for name in [name for name in pending if all(input_name in done or input_name in TABLES
+                        for input_name in STAGES[name]["inputs"])]:
+                    pending.remove(name)
+                    running[executor.submit(run, name)] = name
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    future.result()
+                    done.add(name)
+
+    return {name: get(name) for name in targets}, status
+
+
+def export(artifacts, output_dir):
+    '''
+    Write the artifacts of the targets : tables as csv files (ex: sizing_global.csv), files written by a stage
+    as copies (ex: emissions_server_day.csv), other values as json files.
+
+    Args:
+        artifacts : dict(str: object) = artifact of each target (see run_pipeline)
+        output_dir : str = directory of the files (created if needed)
+    Output:
+        paths : list(str) = written files
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for name, artifact in artifacts.items():
+        parts = artifact if isinstance(artifact, dict) else {None: artifact}
+        values = dict()
+        for part, value in parts.items():
+            if isinstance(value, pd.DataFrame):
+                paths.append(os.path.join(output_dir, f"{name}_{part}.csv" if part is not None else f"{name}.csv"))
+                value.to_csv(paths[-1])
+            elif isinstance(value, str) and os.path.isfile(value):
+                paths.append(os.path.join(output_dir, f"{name}_{part}{os.path.splitext(value)[1]}"))
+                shutil.copyfile(value, paths[-1])
+            else:
+                values[part] = value
+        if values:
+            paths.append(os.path.join(output_dir, f"{name}.json"))
+            with open(paths[-1], "w") as file:
+                json.dump(values, file, indent=1, default=float)
+    return paths
+
+
+def _parse_table(text):
+    # name=path
+    if "=" not in text:
+        raise argparse.ArgumentTypeError(f"expected NAME=PATH, got {text}")
+    return tuple(text.split("=", 1))
+
+
+def _parse_param(text):
+    # stage.name=value, the value is parsed as json when possible (numbers, booleans), as a string otherwise
+    if "=" not in text or "." not in text.split("=", 1)[0]:
+        raise argparse.ArgumentTypeError(f"expected STAGE.NAME=VALUE, got {text}")
+    name, value = text.split("=", 1)
+    stage_name, param = name.split(".", 1)
+    try:
+        value = json.loads(value)
+    except json.JSONDecodeError:
+        pass
+    return stage_name, param, value
+
+
+def parse_arguments(argv=None):
+    '''
+    Parse the command line of the pipeline (see main).
+
+    Args:
+        argv : list(str) = command line arguments (default : sys.argv)
+    Output:
+        args : argparse.Namespace = parsed arguments
+        paths : dict(str: str) = path of each table (see table_paths)
+        params : dict(str: dict) = parameters of the stages, from --config and --param
+    '''
+    parser = argparse.ArgumentParser(description="Run the pipeline stages, skipping the ones whose inputs and parameters did not change.")
+    parser.add_argument("--data-dir", default="data", help="directory of the extraction csv files")
+    parser.add_argument("--suffix", default="20221221", help="extraction date of the file names")
+    parser.add_argument("--table", nargs="+", type=_parse_table, default=[], metavar="NAME=PATH", help="path of a table, replacing the default one")
+    parser.add_argument("--targets", nargs="+", choices=list(STAGES), default=None, help="stages to compute (default : sizing, pricing, emissions)")
+    parser.add_argument("--config", default=None, help="json file of the parameters of the stages ({stage: {name: value}})")
+    parser.add_argument("--param", nargs="+", type=_parse_param, default=[], metavar="STAGE.NAME=VALUE", help="parameter of a stage, ex: periodicity.n_last_days=60")
+    parser.add_argument("--cache-dir", default=".pipeline_cache", help="directory of the cached artifacts")
+    parser.add_argument("--output-dir", default="results", help="directory where the artifacts of the targets are written")
+    parser.add_argument("--workers", type=int, default=4, help="number of stages run concurrently")
+    parser.add_argument("--n-jobs", type=int, default=1, help="number of worker processes of the seasonality cleaning")
+    parser.add_argument("--force", nargs="+", choices=list(STAGES), default=[], help="stages recomputed even if they are cached")
+    parser.add_argument("--chunksize", type=int, default=None, help="number of csv rows converted at once into the item_trend store (default : the whole csv)")
+    parser.add_argument("--dry-run", action="store_true", help="only list the stages to compute")
+    args = parser.parse_args(argv)
+
+    params = dict()
+    if args.config is not None:
+        with open(args.config) as file:
+            params = json.load(file)
+    for stage_name, param, value in args.param:
+        params.setdefault(stage_name, dict())[param] = value
+    return args, table_paths(args.data_dir, args.suffix, dict(args.table)), params
+
+
+def main(argv=None):
+    args, paths, params = parse_arguments(argv)
+
+    if args.dry_run:
+        cache = DiskCache(args.cache_dir)
+        for name, key in plan(paths, args.targets, params, cache).items():
+            if name in STAGES:
+                print(f"{name} : {'to compute' if name in args.force or key not in cache else 'cached'} ({key[:10]}).")
+        return
+
+    artifacts, _ = run_pipeline(paths, args.targets, params, args.cache_dir, args.workers, args.n_jobs, args.force,
+        args.chunksize)
+    for path in export(artifacts, args.output_dir):
+        print(f"Written {path}.")
+
+    # Stage timings, when PIPELINE_INSTRUMENT=1 (see src/instrument.py)
+    write_report()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,5 +1,9 @@
+import numpy as np
 import pandas as pd
 
+from src.instrument import instrumented
+
+
 def find_closest(value, refs):
     '''
     Find the closest value to a float in a list of floats.
@@ -23,16 +27,124 @@ def find_closest(value, refs):
     return value_final
 
 
-def annual_config_price(df_cockpit, df_mycloud):
+class CatalogueIndex:
     '''
-    Calculate the price of a configuration.
+    Sorted index of catalogue reference values, answering closest-value queries for whole arrays.
+
+    Built once (ex: from df_mycloud.RAM or df_mycloud.CPU), each query is a binary search.
+    Ties are broken as in find_closest : among two equally close references, the one
+    appearing first in refs is kept. A missing value gets the first reference.
 
     Args:
-        df_mycloud : pandas.DataFrame(["RAM", "CPU", "Price"]) = table of the configuration
-        df_cockpit : pandas.DataFrame(["ram", "number_cpu", "name_server"]) = table of the catalogue of prices of mycloud servors
+        refs : list(float) = reference values
+    '''
+    def __init__(self, refs):
+        refs = np.asarray(refs)
+        self.values, self.first_position = np.unique(refs, return_index=True)
+
+    def closest(self, values):
+        '''
+        Find the closest reference value of each value.
+
+        Args:
+            values : np.array(float) = values to find the closest of
+        Return:
+            closest : np.array = closest reference value of each value
+        '''
+        values = np.asarray(values, dtype=float)
+        refs = self.values.astype(float)
+
+        upper = np.clip(np.searchsorted(refs, values), 0, len(refs) - 1)
+        lower = np.maximum(upper - 1, 0)
+        distance_lower, distance_upper = np.abs(values - refs[lower]), np.abs(values - refs[upper])
+
+        # on ties, keep the reference appearing first in refs
+        take_lower = (distance_lower < distance_upper)\
+            | ((distance_lower == distance_upper) & (self.first_position[lower] < self.first_position[upper]))
+        closest = np.where(take_lower, lower, upper)
+
+        # missing values get the first reference, as in find_closest
+        closest[np.isnan(values)] = np.argmin(self.first_position)
+
+        return self.values[closest]
+
+
+class PriceTable:
+    '''
+    Compiled (RAM, CPU) -> price table of the catalogue, for high-rate pricing of configurations.
+
+    Prices are stored in a dense 2D array indexed by the positions of the catalogue RAM and CPU values.
+    A server is priced at the catalogue RAM closest to its ram (see CatalogueIndex) and at its exact
+    number of cpu. Combinations absent from the catalogue are flagged as unmatched.
+
+    Args:
+        df_mycloud : pandas.DataFrame(["RAM", "CPU", "Price"]) = catalogue of prices of mycloud servors
+    '''
+    def __init__(self, df_mycloud):
+        self.ram_index = CatalogueIndex(df_mycloud.RAM.unique())
+        self.ram_values = np.unique(df_mycloud.RAM.to_numpy(dtype=float))
+        self.cpu_values = np.unique(df_mycloud.CPU.to_numpy(dtype=float))
+
+        # duplicated (RAM, CPU) configurations add up, as in a merge on the catalogue
+        prices = df_mycloud.groupby(["RAM", "CPU"]).Price.sum()
+        self.prices = np.full((len(self.ram_values), len(self.cpu_values)), np.nan)
+        self.prices[np.searchsorted(self.ram_values, prices.index.get_level_values("RAM").to_numpy(dtype=float)),
+            np.searchsorted(self.cpu_values, prices.index.get_level_values("CPU").to_numpy(dtype=float))] = prices.values
+
+    def lookup(self, ram, number_cpu):
+        '''
+        Price of each server (ram in GB, any array shape).
+
+        Return:
+            prices : np.array(float) = price of each server (NaN when unmatched)
+            ram_ref : np.array(float) = catalogue RAM of each server
+            matched : np.array(bool) = whether the (RAM, CPU) combination exists in the catalogue
+        '''
+        ram_ref = self.ram_index.closest(np.ravel(ram)).astype(float).reshape(np.shape(ram))
+        number_cpu = np.asarray(number_cpu, dtype=float)
+
+        ram_position = np.searchsorted(self.ram_values, ram_ref)
+        cpu_position = np.clip(np.searchsorted(self.cpu_values, number_cpu), 0, len(self.cpu_values) - 1)
+        prices = np.where(self.cpu_values[cpu_position] == number_cpu, self.prices[ram_position, cpu_position], np.nan)
+
+        return prices, ram_ref, ~np.isnan(prices)
+
+
+def price_configurations(ram, number_cpu, price_table):
+    '''
+    Price many candidate configurations of the fleet at once.
+
+    Args:
+        ram : np.array(float) (n_configurations x n_servers) = ram (GB) of each server in each configuration
+        number_cpu : np.array(int) (n_configurations x n_servers) = number of cpu of each server in each configuration
+        price_table : PriceTable = compiled catalogue prices
     
     Return:
-        price : float = total price of the configuration
+        prices : np.array(float) (n_configurations) = total price of each configuration (unmatched servers excluded)
+        unmatched : pd.DataFrame(["configuration", "RAM", "CPU", "n_servers"]) = servers of each configuration
+            whose (RAM, CPU) combination does not exist in the catalogue
+    '''
+    ram, number_cpu = np.atleast_2d(ram), np.atleast_2d(number_cpu)
+    server_prices, ram_ref, matched = price_table.lookup(ram, number_cpu)
+
+    configuration, server = np.nonzero(~matched)
+    unmatched = pd.DataFrame({"configuration": configuration,
+        "RAM": ram_ref[configuration, server],
+        "CPU": number_cpu[configuration, server]})
+    unmatched = unmatched.groupby(["configuration", "RAM", "CPU"]).size().rename("n_servers").reset_index()
+
+    return np.where(matched, server_prices, 0).sum(axis=1), unmatched
+
+
+def fleet_servers(df_cockpit):
+    '''
+    List the mycloud servers of a configuration, with their ram in GB.
+
+    Args:
+        df_cockpit : pandas.DataFrame(["ram", "number_cpu", "name_server"]) = table of the configuration
+    
+    Return:
+        info_servers : pandas.DataFrame(["ram", "number_cpu", "name_server"]) = one row per server
     '''
     # Extract usable data : mycloud servors only
     if "mycloud" in df_cockpit.columns:
@@ -45,40 +157,153 @@ def annual_config_price(df_cockpit, df_mycloud):
         config["ram"] = config.ram/1000 
 
     # Extract the list of servers (multiple applications correspond to one server)
-    info_servers = config[["ram", "number_cpu", "name_server"]].drop_duplicates()
+    return config[["ram", "number_cpu", "name_server"]].drop_duplicates()
+
+
+def annual_config_price(df_cockpit, df_mycloud, price_table=None):
+    '''
+    Calculate the price of a configuration.
+
+    Args:
+        df_mycloud : pandas.DataFrame(["RAM", "CPU", "Price"]) = table of the configuration
+        df_cockpit : pandas.DataFrame(["ram", "number_cpu", "name_server"]) = table of the catalogue of prices of mycloud servors
+        price_table : PriceTable = compiled catalogue prices (default : built from df_mycloud)
     
-    # Find the servors in the catalogue
-    info_servers["ram_ref"] = info_servers.ram.apply(lambda x: find_closest(x, df_mycloud.RAM.unique()))
+    Return:
+        price : float = total price of the configuration
+    '''
+    info_servers = fleet_servers(df_cockpit)
+
+    # Find the servors in the catalogue and add prices
+    if price_table is None:
+        price_table = PriceTable(df_mycloud)
+    prices, unmatched = price_configurations(info_servers.ram.to_numpy(), info_servers.number_cpu.to_numpy(), price_table)
 
-    # Add prices
-    info_servers = info_servers.merge(df_mycloud, how="left", left_on=["ram_ref", "number_cpu"], right_on=["RAM", "CPU"])
-    if "number_cpu" in info_servers.columns:
-        info_servers = info_servers.drop(["number_cpu"], axis=1)
-    if "ram_ref" in info_servers.columns:
-        info_servers = info_servers.drop(["ram_ref"], axis=1)
+    if len(unmatched):
+        print(f"{unmatched.n_servers.sum()} server(s) without catalogue configuration are not priced : "
+            f"{list(zip(unmatched.RAM, unmatched.CPU))} (RAM, CPU).")
 
     # Calculate the price.
-    config_price = info_servers.Price.sum()
+    config_price = prices[0]
 
     return config_price
 
-def total_saturation_cost(df_item_trend,\
+def saturation_counts(df_item_trend, saturation_threshold=99):
+    '''
+    Count the days of full saturation and of partial saturation in df_item_trend.
+
+    Args:
+        df_item_trend : pd.DataFrame([value_avg, value_max]) = table listing the usage of all servers per day
+        saturation_threshold : int = usage percentage from which we consider that the item is saturated
+
+    Output:
+        n_full_days : int = number of days saturated all day long (average usage above the threshold)
+        n_partial_days : int = number of days saturated part of the day (only maximum usage above the threshold)
+    '''
+    n_full_days = (df_item_trend["value_avg"]>saturation_threshold).sum()
+    n_partial_days = ((df_item_trend["value_avg"]<saturation_threshold)\
+        &(df_item_trend["value_max"]>saturation_threshold)).sum()
+
+    return n_full_days, n_partial_days
+
+class SaturationIndex:
+    '''
+    Index of the daily usages answering the saturation counts of any threshold without rescanning the history.
+
+    A day is fully saturated at a threshold t when value_avg > t, and partially saturated when
+    value_avg < t < value_max : only days with value_avg < value_max can be partially saturated.
+    The index keeps value_avg, and value_avg / value_max of the partial candidates, sorted once :
+    the position of a threshold in these arrays is the cumulative count of days under it,
+    so the counts of a threshold are given by binary search (O(log n)).
+
+    With `by`, the values are sorted by (group, value) and the counts are also available per group
+    (per item with by="itemid", per server with a server column).
+
+    Args:
+        df_item_trend : pd.DataFrame([value_avg, value_max]) = table listing the usage of all servers per day
+        by : str = column of the groups to count by (default : no groups)
+    '''
+    def __init__(self, df_item_trend, by=None):
+        value_avg = df_item_trend["value_avg"].to_numpy(dtype=float)
+        value_max = df_item_trend["value_max"].to_numpy(dtype=float)
+        partial = value_avg < value_max
+        full = ~np.isnan(value_avg)
+
+        self.sorted_avg = np.sort(value_avg[full])
+        self.sorted_partial_avg = np.sort(value_avg[partial])
+        self.sorted_partial_max = np.sort(value_max[partial])
+
+        self.by = by
+        if by is None:
+            return
+        codes, self.groups = pd.factorize(df_item_trend[by], sort=True)
+        # distinct values : a value is replaced by its rank, so that (group, rank) fits one sorted integer key
+        self.values = np.unique(np.concatenate([self.sorted_avg, self.sorted_partial_avg, self.sorted_partial_max]))
+        self._full_keys = self._keys(codes[full], value_avg[full])
+        self._partial_avg_keys = self._keys(codes[partial], value_avg[partial])
+        self._partial_max_keys = self._keys(codes[partial], value_max[partial])
+
+    def _keys(self, codes, values):
+        return np.sort(codes.astype(np.int64) * len(self.values) + np.searchsorted(self.values, values))
+
+    def _group_positions(self, keys, threshold, side):
+        # number of values of each group under the threshold
+        ranks = np.searchsorted(self.values, threshold, side=side)
+        group_start = np.arange(len(self.groups), dtype=np.int64) * len(self.values)
+        return np.searchsorted(keys, group_start + ranks) - np.searchsorted(keys, group_start)
+
+    def counts(self, saturation_threshold=99):
+        '''
+        Count the days of full saturation and of partial saturation (see saturation_counts).
+
+        Args:
+            saturation_threshold : float or np.array(float) = usage percentage(s) from which we consider that the item is saturated
+        Output:
+            n_full_days : int or np.array(int) = number of days saturated all day long, for each threshold
+            n_partial_days : int or np.array(int) = number of days saturated part of the day, for each threshold
+        '''
+        n_full_days = len(self.sorted_avg) - np.searchsorted(self.sorted_avg, saturation_threshold, side="right")
+        n_partial_days = np.searchsorted(self.sorted_partial_avg, saturation_threshold, side="left")\
+            - np.searchsorted(self.sorted_partial_max, saturation_threshold, side="right")
+
+        return n_full_days, n_partial_days
+
+    def group_counts(self, saturation_threshold=99):
+        '''
+        Count the days of full saturation and of partial saturation of each group.
+
+        Args:
+            saturation_threshold : float = usage percentage from which we consider that the item is saturated
+        Output:
+            df_counts : pd.DataFrame([n_full_days, n_partial_days]) = number of saturated days, indexed by group
+        '''
+        if self.by is None:
+            raise ValueError("The index has no groups : build it with the `by` argument.")
+        n_values = np.bincount(self._full_keys // len(self.values), minlength=len(self.groups))
+        n_full_days = n_values - self._group_positions(self._full_keys, saturation_threshold, "right")
+        n_partial_days = self._group_positions(self._partial_avg_keys, saturation_threshold, "left")\
+            - self._group_positions(self._partial_max_keys, saturation_threshold, "right")
+
+        return pd.DataFrame({"n_full_days": n_full_days, "n_partial_days": n_partial_days},
+            index=pd.Index(self.groups, name=self.by))
+
+def saturation_cost_from_counts(n_full_days,\
+    n_partial_days,
     salary_year=40000, 
     number_users=1, 
     project_daily_value=0, 
-    saturation_threshold = 99,
     average_saturation_duration = 0.1,
     user_dependance = 0.6
     ):
     '''
-    Estimate the total saturation cost over the df_item_trend period.
+    Estimate the total saturation cost from the number of saturated days (see saturation_counts).
 
     Args:        
-        df_item_trend : pd.DataFrame = table listing the cpu usage of all servers per day
+        n_full_days : int = number of days saturated all day long
+        n_partial_days : int = number of days saturated part of the day
         salary_year : int = annual average salary of the people working with the servers
         number_users : int = average number of users depending on the applications
         project_daily_value : daily financial impact of delay of the project 
-        saturation_threshold : int = usage percentage from which we consider that the item is saturated
         average_saturation_duration : float = average duration of a saturation (proportion of one day)
         user_dependance : float = proportion of the user's time that depends on the app
 
@@ -90,38 +315,91 @@ def total_saturation_cost(df_item_trend,\
     salary_day = salary_year/365
     saturation_cost_full_day = (user_dependance * number_users * salary_day) + project_daily_value
 
-    # Add a saturation cost column
-    df = df_item_trend.copy()
-    df["saturation_cost"] = 0
-    df.loc[df["value_avg"]>saturation_threshold, "saturation_cost"] = saturation_cost_full_day
-    df.loc[(df["value_avg"]<saturation_threshold)&(df["value_max"]>saturation_threshold), "saturation_cost"]\
-        = average_saturation_duration * saturation_cost_full_day
-
-    # calculate total saturation cost
-    total_saturation_cost = df.saturation_cost.sum()
+    # full days cost a full day of saturation, partial days a fraction of it
+    total_saturation_cost = n_full_days * saturation_cost_full_day\
+        + n_partial_days * average_saturation_duration * saturation_cost_full_day
 
     return total_saturation_cost
 
-def ts_duration_mean(df_item_trend):
+def total_saturation_cost(df_item_trend,\
+    salary_year=40000, 
+    number_users=1, 
+    project_daily_value=0, 
+    saturation_threshold = 99,
+    average_saturation_duration = 0.1,
+    user_dependance = 0.6,
+    saturation_index=None
+    ):
     '''
-    Calculate the average duration covered by the time series of df_item_trend.
+    Estimate the total saturation cost over the df_item_trend period.
+
+    Args:        
+        df_item_trend : pd.DataFrame = table listing the cpu usage of all servers per day
+        salary_year : int = annual average salary of the people working with the servers
+        number_users : int = average number of users depending on the applications
+        project_daily_value : daily financial impact of delay of the project 
+        saturation_threshold : int = usage percentage from which we consider that the item is saturated
+        average_saturation_duration : float = average duration of a saturation (proportion of one day)
+        user_dependance : float = proportion of the user's time that depends on the app
+        saturation_index : SaturationIndex = index of df_item_trend, to count the saturations without scanning it
+
+    Output:
+        total_saturation_cost : int = total saturation cost estimation in euros
+    '''
+    if saturation_index is None:
+        n_full_days, n_partial_days = saturation_counts(df_item_trend, saturation_threshold)
+    else:
+        n_full_days, n_partial_days = saturation_index.counts(saturation_threshold)
+
+    return saturation_cost_from_counts(n_full_days,
+        n_partial_days,
+        salary_year, 
+        number_users, 
+        project_daily_value, 
+        average_saturation_duration,
+        user_dependance)
+
+def item_date_ranges(df_item_trend):
+    '''
+    First and last date of the time series of each item.
 
     Args:
         df_item_trend : pd.DataFrame([itemid, clock]) = table of the time series
     Output: 
-        duration_avg : float = average duration
+        df_date_ranges : pd.DataFrame([min_date, max_date]) = date range of each itemid
     '''
-    df_item_trend["clock"] = pd.to_datetime(df_item_trend.clock).copy()
+    clock = pd.to_datetime(df_item_trend.clock).rename("max_date")
+    df_date_ranges = clock.groupby(df_item_trend.itemid).max().to_frame()
+    df_date_ranges["min_date"] = clock.groupby(df_item_trend.itemid).min()
+
+    return df_date_ranges[["min_date", "max_date"]]
 
-    df_avg_duration = df_item_trend[['itemid', "clock"]].rename(columns={'clock': 'max_date'}).groupby("itemid").max()
-    df_avg_duration["min_date"] = df_item_trend[['itemid', "clock"]].groupby("itemid").min()
-    df_avg_duration["duration_year"] = (df_avg_duration.max_date - df_avg_duration.min_date)\
+def duration_mean_from_ranges(df_date_ranges):
+    '''
+    Calculate the average duration covered by time series, from their date ranges (see item_date_ranges).
+
+    Args:
+        df_date_ranges : pd.DataFrame([min_date, max_date]) = date range of each itemid
+    Output: 
+        duration_avg : float = average duration
+    '''
+    duration_year = (df_date_ranges.max_date - df_date_ranges.min_date)\
         .apply(lambda x: x.total_seconds()/(365.25*24*60*60))
-    
-    duration_avg = df_avg_duration.duration_year.mean()
 
-    return duration_avg
+    return duration_year.mean()
+
+def ts_duration_mean(df_item_trend):
+    '''
+    Calculate the average duration covered by the time series of df_item_trend.
+
+    Args:
+        df_item_trend : pd.DataFrame([itemid, clock]) = table of the time series
+    Output: 
+        duration_avg : float = average duration
+    '''
+    return duration_mean_from_ranges(item_date_ranges(df_item_trend))
 
+@instrumented()
 def get_all_costs(df_cockpit,\
     df_mycloud, 
     df_item_trend,
@@ -172,4 +450,73 @@ def get_all_costs(df_cockpit,\
     print(f"Time-series average duration : {int(ts_average_duration.round())} years.")
     print(f"Total annual configuration expenses (servers' usage and saturation) : {int(total_annual_config_price.round())}€.")
 
-    return annual_conf_price, total_sat_cost, ts_average_duration, total_annual_config_price
\ No newline at end of file
+    return annual_conf_price, total_sat_cost, ts_average_duration, total_annual_config_price
+
+@instrumented()
+def sweep_costs(df_cockpit,\
+    df_mycloud, 
+    df_item_trend,
+    salary_year=[40000], 
+    number_users=[1], 
+    project_daily_value=[0], 
+    saturation_threshold=[99],
+    average_saturation_duration=[0.1],
+    user_dependance=[0.6],
+    price_table=None,
+    saturation_index=None):
+    '''
+    Compute the costs of get_all_costs for every combination of the parameter grids.
+
+    The configuration price and the time-series duration do not depend on the parameters : they
+    are computed once. The saturation counts of all thresholds are looked up in a SaturationIndex,
+    and the costs of all combinations are broadcast from these counts.
+
+    Args:
+        df_cockpit : pandas.DataFrame(["ram", "number_cpu", "name_server"]) = table of the configuration
+        df_mycloud : pandas.DataFrame(["RAM", "CPU", "Price"]) = table of the catalogue of prices of mycloud servors
+        df_item_trend : pd.DataFrame([itemid, clock, value_avg, value_max]) = table of the time series
+        salary_year, number_users, project_daily_value, saturation_threshold,
+        average_saturation_duration, user_dependance : list = grid of values of each parameter (see get_all_costs)
+        price_table : PriceTable = compiled catalogue prices (default : built from df_mycloud)
+        saturation_index : SaturationIndex = index of df_item_trend (default : built from df_item_trend)
+    Outputs:
+        df_costs : pd.DataFrame = one row per combination of parameters, with the parameters, the number of
+            saturated days and the costs (annual_config_price, total_saturation_cost, ts_average_duration,
+            total_annual_config_price)
+    '''
+    grids = {
+        "salary_year": salary_year,
+        "number_users": number_users,
+        "project_daily_value": project_daily_value,
+        "saturation_threshold": saturation_threshold,
+        "average_saturation_duration": average_saturation_duration,
+        "user_dependance": user_dependance,
+    }
+    mesh = np.meshgrid(*[np.atleast_1d(grid) for grid in grids.values()], indexing="ij")
+    df_costs = pd.DataFrame({name: values.ravel() for name, values in zip(grids, mesh)})
+
+    # Statistics that do not depend on the parameters
+    annual_conf_price = annual_config_price(df_cockpit, df_mycloud, price_table)
+    ts_average_duration = ts_duration_mean(df_item_trend)
+
+    # Saturation counts of each threshold, broadcast to the combinations
+    thresholds = np.unique(df_costs.saturation_threshold)
+    if saturation_index is None:
+        saturation_index = SaturationIndex(df_item_trend)
+    n_full_days, n_partial_days = saturation_index.counts(thresholds)
+    threshold_position = np.searchsorted(thresholds, df_costs.saturation_threshold)
+    df_costs["n_full_days"] = n_full_days[threshold_position]
+    df_costs["n_partial_days"] = n_partial_days[threshold_position]
+
+    df_costs["annual_config_price"] = annual_conf_price
+    df_costs["total_saturation_cost"] = saturation_cost_from_counts(df_costs.n_full_days,
+        df_costs.n_partial_days,
+        df_costs.salary_year, 
+        df_costs.number_users, 
+        df_costs.project_daily_value, 
+        df_costs.average_saturation_duration,
+        df_costs.user_dependance)
+    df_costs["ts_average_duration"] = ts_average_duration
+    df_costs["total_annual_config_price"] = df_costs.total_saturation_cost/ts_average_duration + annual_conf_price
+
+    return df_costs
@@ -1,33 +1,32 @@
+import time
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 
-from fbprophet import Prophet
+from src.cache import make_key
+from src.pricing import CatalogueIndex
+from src.model import evaluate, fitted_params
+from src.harmonic import harmonic_clean_batch
+from src.instrument import instrumented, record_item
 
-from src.pricing import find_closest
-from src.model import evaluate
 
+FOURIER_ORDER = 5
 
-def clean(train, valid, seasonality_periods=[7, 30.5]):
-    '''Model a time series through its seasonalities only : clean out ponctual events.
+# A warm-started fit whose in-sample RMSE exceeds the previous one by this ratio diverged
+DIVERGENCE_RATIO = 1.5
+
+
+def clean_params():
+    '''Prophet parameters used by the seasonality cleaning.
 
-    Args:
-        train : pd.DataFrame = training set time-series
-        valid : pd.DataFrame = validation set time-series
-        list_seasonalities : list(int) = list of the periods of each seasonality
-    
     Output:
-        new_df : pd.DataFrame = cleaned time series
+        params : dict = parameters of the Prophet model
     '''
-
-    ######################
-    #PARAMETERS
     params = dict()
 
     # Saturation at 100
     params['growth'] = 'logistic'
-    train["cap"] = 100
-    valid["cap"] = 100
 
     # Weight of each seasonlity
     params['seasonality_prior_scale'] = 10
@@ -39,16 +38,48 @@ def clean(train, valid, seasonality_periods=[7, 30.5]):
     #params["yearly_seasonality"] = False
     #params["monthly_seasonality"] = False
     params["weekly_seasonality"] = False
+
+    return params
+
+
+def clean(train, valid, seasonality_periods=[7, 30.5], return_model=False, init=None):
+    '''Model a time series through its seasonalities only : clean out ponctual events.
+
+    Args:
+        train : pd.DataFrame = training set time-series
+        valid : pd.DataFrame = validation set time-series
+        list_seasonalities : list(int) = list of the periods of each seasonality
+        return_model : bool = also return the fitted Prophet model
+        init : dict = initial values of the fit, from a previous fit of the item (see model.fitted_params, None : cold start)
+    
+    Output:
+        new_df : pd.DataFrame = cleaned time series
+        model : Prophet = fitted model (only if return_model)
+    '''
+
+    # Prophet is only needed by the Prophet engine (see harmonic.py for the other one)
+    from fbprophet import Prophet
+
+    ######################
+    #PARAMETERS
+    params = clean_params()
+
+    # Saturation at 100
+    train["cap"] = 100
+    valid["cap"] = 100
     #######################
 
     # Set model
     model = Prophet(**params)
     for period in seasonality_periods:
-        model.add_seasonality(period=period, name=f'seasonality_{period}', fourier_order=5)
+        model.add_seasonality(period=period, name=f'seasonality_{period}', fourier_order=FOURIER_ORDER)
 
     # Predict
     df = pd.concat([train, valid], axis=0)
-    model.fit(train)
+    if init is None:
+        model.fit(train)
+    else:
+        model.fit(train, init=init)
     pred = model.predict(df)
     pred['y'] = np.array(df.y)
 
@@ -64,29 +95,56 @@ def clean(train, valid, seasonality_periods=[7, 30.5]):
     #ts_fig.update_layout(title_text=f'Logistic function', title_x=0.5)
 
     print(f"Scores : {scores}.")
+    if return_model:
+        return pred[["ds", "y", "yhat_lower", "yhat", "yhat_upper"]], model
     return pred[["ds", "y", "yhat_lower", "yhat", "yhat_upper"]]
 
 
-def clean_multiple(item_trend, df_periods):
+def clean_cache_key(item_id, periods, sample):
     '''
-    Apply the seasonality cleaning on multiple time-series along their seasonality periods. 
+    Cache key of a cleaned time-series : the item, its seasonality periods, the Prophet parameters
+    and a hash of the training data.
+    '''
+    train = pd.DataFrame({'ds': pd.to_datetime(sample.clock), "y": sample.value_max})
+    return make_key(int(item_id), sorted(periods), sorted(clean_params().items()), FOURIER_ORDER, train)
+
+
+def warm_start_key(item_id, periods):
+    '''
+    Cache key of the fitted parameters of an item : the item, its seasonality periods and the Prophet
+    parameters, but not its history, so that the next fit after new days starts from them.
+    '''
+    return make_key("params", int(item_id), sorted(periods), sorted(clean_params().items()), FOURIER_ORDER)
+
+
+def _in_sample_rmse(output, train):
+    # RMSE of a cleaning on its training rows (the first rows of its output)
+    return evaluate(output.iloc[:len(train)], train)["RMSE"]
+
+
+def _clean_item(item_id, sample, periods, cache=None, key=None, warm_key=None):
+    '''
+    Clean the time-series of one item (worker of clean_multiple).
 
     Args:
-        item_trend : pd.DataFrame = table of the time series, with their ids
-        df_periods : pd.DataFrame = table listing the seasonality periods of each time-series
+        item_id : int = id of the item
+        sample : pd.DataFrame([clock, value_max]) = time-series of the item
+        periods : list(float) = seasonality periods of the item
+        cache : DiskCache = cache where the fitted model and its predictions are stored (None : no cache)
+        key : str = cache key of the item (see clean_cache_key)
+        warm_key : str = cache key of the fitted parameters of the item (see warm_start_key, None : cold fit)
     
     Output:
-        final_df : pd.DataFrame = table of the cleaned time-series
+        item_id : int = id of the item
+        output : pd.DataFrame = cleaned time-series (None if the cleaning failed)
+        error : str = error message (None if the cleaning succeeded)
+        seconds : float = duration of the cleaning
+        fit : str = "cold", "warm" (started from the previous parameters), "fallback" (cold fit after a diverged
+            warm fit) or "none" (no periods)
     '''
-    final_df = pd.DataFrame(columns=["ds", "y", "yhat", "yhat_upper", "itemid"])
-    for item_idx in tqdm(range(len(df_periods))):
-        item = df_periods.loc[item_idx, :]
-        item_id = item.itemid
-        periods = item.drop('itemid')
-        periods = [period for period in periods if str(period)!="nan"]
-
-        # Original time-series
-        sample = item_trend[item_trend.itemid==item_id]
+    start = time.perf_counter()
+    fit = "none"
+    try:
         df = pd.DataFrame({'ds': sample.clock, "y": sample.value_max}) # We keep max value for dimensioning
         df['ds'] = pd.to_datetime(df['ds'])
 
@@ -96,19 +154,204 @@ def clean_multiple(item_trend, df_periods):
 
         # If there are periods, we clean the time-serie
         if len(periods)!=0:
+            # Warm start from the previous parameters of the item, cold fit if it fails or diverges
+            init = cache.get(warm_key) if cache is not None and warm_key is not None else None
+            fit = "cold"
+            if init is not None:
+                try:
+                    output, model = clean(train.copy(), valid.copy(), periods, return_model=True, init=init["params"])
+                    diverged = not np.isfinite(output.yhat).all() \
+                        or _in_sample_rmse(output, train) > DIVERGENCE_RATIO * init["rmse"]
+                except Exception:
+                    diverged = True
+                fit = "fallback" if diverged else "warm"
+
             # Clean time series
-            output = clean(train, valid, periods)
+            if fit != "warm":
+                output, model = clean(train, valid, periods, return_model=True)
+            if cache is not None:
+                from fbprophet.serialize import model_to_json
+                cache.put(key, {"model": model_to_json(model), "pred": output})
+                if warm_key is not None:
+                    cache.put(warm_key, {"params": fitted_params(model), "rmse": _in_sample_rmse(output, train)})
         else:
             output = df.copy()
         output["itemid"] = item_id
+        return item_id, output, None, time.perf_counter() - start, fit
+
+    except Exception as error:
+        return item_id, None, f"{type(error).__name__}: {error}", time.perf_counter() - start, fit
+
+
+@instrumented()
+def clean_multiple(item_trend, df_periods, n_jobs=1, return_failures=False, cache=None, engine="prophet",
+    warm_start=False, return_timings=False):
+    '''
+    Apply the seasonality cleaning on multiple time-series along their seasonality periods. 
+
+    The trend table is grouped by itemid once. With n_jobs > 1, items are cleaned in parallel
+    on a pool of processes. Items whose cleaning fails are reported and left out of the output.
+    With a cache, only the items whose history, periods or parameters changed are refitted.
+    With warm_start, the fitted parameters of each item are also cached, and the refit of an item
+    whose history changed (ex: a new day) starts from them instead of a cold start.
+    The harmonic engine fits all the items at once with a batched harmonic regression
+    (see harmonic.harmonic_clean_batch) instead of one Prophet model per item.
 
-        # Collect output
-        final_df = pd.concat([final_df, output], axis=0)
+    Args:
+        item_trend : pd.DataFrame = table of the time series, with their ids
+        df_periods : pd.DataFrame = table listing the seasonality periods of each time-series
+        n_jobs : int = number of worker processes (1 : serial execution)
+        return_failures : bool = also return the table of the failed items
+        cache : DiskCache = cache of the fitted models and their predictions (None : no cache, prophet engine only)
+        engine : str = cleaning engine, "prophet" or "harmonic"
+        warm_start : bool = warm-start the refits from the cached parameters of the items (requires a cache with
+            the prophet engine, ValueError otherwise)
+        return_timings : bool = also return the fit time of each item
     
-    return final_df
+    Output:
+        final_df : pd.DataFrame = table of the cleaned time-series
+        failures : pd.DataFrame([itemid, error]) = table of the failed items (only if return_failures)
+        timings : pd.DataFrame([itemid, fit, seconds]) = fit type (cached, cold, warm, fallback, harmonic or none)
+            and fit time of each item (only if return_timings)
+    '''
+    if engine not in ["prophet", "harmonic"]:
+        raise ValueError(f"Unknown cleaning engine : {engine}.")
+    if warm_start and engine == "prophet" and cache is None:
+        raise ValueError("warm_start requires a cache, where the fitted parameters of the items are kept.")
+    cache = cache if engine == "prophet" else None
+
+    # Original time-series, grouped once
+    samples = {item_id: sample for item_id, sample in item_trend[["itemid", "clock", "value_max"]].groupby("itemid")}
+    empty_sample = item_trend[["clock", "value_max"]].iloc[:0]
+
+    results = [None] * len(df_periods)
+    tasks = []
+    for item_idx in range(len(df_periods)):
+        item = df_periods.iloc[item_idx, :]
+        item_id = item.itemid
+        periods = item.drop('itemid')
+        periods = [period for period in periods if str(period)!="nan"]
+        sample = samples.get(item_id, empty_sample)
+
+        # Reuse the cached cleaning when the item did not change
+        key, cached = None, None
+        if cache is not None and len(periods)!=0 and len(sample)!=0:
+            key = clean_cache_key(item_id, periods, sample)
+            cached = cache.get(key)
+        if cached is not None:
+            output = cached["pred"]
+            output["itemid"] = item_id
+            results[item_idx] = (item_id, output, None, 0.0, "cached")
+        else:
+            warm_key = warm_start_key(item_id, periods) if warm_start and key is not None else None
+            tasks.append((item_idx, (item_id, sample, periods, cache, key, warm_key)))
+
+    if cache is not None:
+        print(f"{len(df_periods) - len(tasks)} item(s) loaded from cache, {len(tasks)} item(s) to process.")
+
+    remaining = tasks
+    if engine == "harmonic":
+        # Items with periods are fitted together, the others are processed as usual
+        seasonal = [(item_idx, task) for item_idx, task in tasks if len(task[2]) != 0]
+        remaining = [(item_idx, task) for item_idx, task in tasks if len(task[2]) == 0]
+
+        start = time.perf_counter()
+        trains = [pd.DataFrame({'ds': pd.to_datetime(task[1].clock), "y": task[1].value_max}) for _, task in seasonal]
+        preds, errors = harmonic_clean_batch(trains, [task[2] for _, task in seasonal], fourier_order=FOURIER_ORDER)
+        seconds = (time.perf_counter() - start) / max(len(seasonal), 1)
+
+        for (item_idx, task), pred, error in zip(seasonal, preds, errors):
+            if pred is not None:
+                pred["itemid"] = task[0]
+            results[item_idx] = (task[0], pred, error, seconds, "harmonic")
+
+    if n_jobs == 1:
+        for item_idx, task in tqdm(remaining):
+            results[item_idx] = _clean_item(*task)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {executor.submit(_clean_item, *task): item_idx for item_idx, task in remaining}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                results[futures[future]] = future.result()
+
+    # Fit time and failure of each processed item (cached items are not refitted,
+    # items of the harmonic engine share the time of their batch)
+    for item_idx, _ in tasks:
+        item_id, _, error, seconds, fit = results[item_idx]
+        record_item("clean_multiple", item_id, seconds, error, fit=fit)
+
+    if cache is not None:
+        cache.evict()
+
+    # Collect outputs once
+    outputs = [output for _, output, _, _, _ in results if output is not None]
+    failures = pd.DataFrame([(item_id, error) for item_id, _, error, _, _ in results if error is not None],
+        columns=["itemid", "error"])
+    timings = pd.DataFrame([(item_id, fit, seconds) for item_id, _, _, seconds, fit in results],
+        columns=["itemid", "fit", "seconds"])
+    final_df = pd.concat([pd.DataFrame(columns=["ds", "y", "yhat_lower", "yhat", "yhat_upper", "itemid"])] + outputs, axis=0)
+
+    if warm_start and len(timings):
+        fits = timings.groupby("fit").seconds.agg(["size", "mean"])
+        print("Refits : " + ", ".join(f"{size} {fit} ({mean:.2f}s per item)" for fit, size, mean in zip(fits.index, fits["size"], fits["mean"])) + ".")
+    if len(failures):
+        print(f"Cleaning failed for {len(failures)} item(s) : {failures.itemid.tolist()}.")
+
+    outputs = [final_df]
+    if return_failures:
+        outputs.append(failures)
+    if return_timings:
+        outputs.append(timings)
+    return tuple(outputs) if len(outputs) > 1 else final_df
+
+
+def compare_engines(item_trend, df_periods, n_valid_days=30):
+    '''
+    Compare the Prophet and harmonic cleanings : both are fitted on the history of each item but its
+    last n_valid_days days, and scored on these days (see model.evaluate).
+
+    Args:
+        item_trend : pd.DataFrame = table of the time series, with their ids
+        df_periods : pd.DataFrame = table listing the seasonality periods of each time-series
+        n_valid_days : int = number of last days of each item used for the validation
+
+    Output:
+        scores : pd.DataFrame([itemid, engine, RMSE, MAPE, seconds, error]) = scores of each item and engine
+    '''
+    samples = {item_id: sample for item_id, sample in item_trend[["itemid", "clock", "value_max"]].groupby("itemid")}
+    items = []
+    for item_idx in range(len(df_periods)):
+        item = df_periods.iloc[item_idx, :]
+        periods = [period for period in item.drop('itemid') if str(period)!="nan"]
+        sample = samples.get(item.itemid)
+        if len(periods)!=0 and sample is not None and len(sample) > n_valid_days:
+            df = pd.DataFrame({'ds': pd.to_datetime(sample.clock), "y": sample.value_max}).sort_values("ds", ignore_index=True)
+            items.append((item.itemid, periods, df.iloc[:-n_valid_days], df.iloc[-n_valid_days:].reset_index(drop=True)))
+
+    scores = []
+    for item_id, periods, train, valid in items:
+        start = time.perf_counter()
+        try:
+            pred = clean(train.copy(), valid.copy(), periods)
+            scores.append({"itemid": item_id, "engine": "prophet", **evaluate(pred, valid),
+                "seconds": time.perf_counter() - start, "error": None})
+        except Exception as error:
+            scores.append({"itemid": item_id, "engine": "prophet", "RMSE": np.nan, "MAPE": np.nan,
+                "seconds": time.perf_counter() - start, "error": f"{type(error).__name__}: {error}"})
+
+    start = time.perf_counter()
+    preds, errors = harmonic_clean_batch([train for _, _, train, _ in items], [periods for _, periods, _, _ in items],
+        [valid for _, _, _, valid in items], fourier_order=FOURIER_ORDER)
+    seconds = (time.perf_counter() - start) / max(len(items), 1)
+    for (item_id, _, _, valid), pred, error in zip(items, preds, errors):
+        item_scores = evaluate(pred, valid) if pred is not None else {"RMSE": np.nan, "MAPE": np.nan}
+        scores.append({"itemid": item_id, "engine": "harmonic", **item_scores, "seconds": seconds, "error": error})
+
+    return pd.DataFrame(scores, columns=["itemid", "engine", "RMSE", "MAPE", "seconds", "error"])
 
 
-def format_output(ts, df_item_info, df_tmp_hosts_zabbix, df_cockpit, df_mycloud):
+@instrumented()
+def format_output(ts, df_item_info, df_tmp_hosts_zabbix, df_cockpit, df_mycloud, ram_index=None):
     '''
     Format output dataframe for the final capacity optimization.
 
@@ -118,6 +361,7 @@ def format_output(ts, df_item_info, df_tmp_hosts_zabbix, df_cockpit, df_mycloud)
         df_tmp_hosts_zabbix : pd.DataFrame([server name, server id]) = table referencing the name of each server 
         df_cockpit : pd.DataFrame = table referencing the server used for each application
         df_mycloud : pd.DataFrame = catalogue table of the servers
+        ram_index : CatalogueIndex = index of the catalogue ram values (default : built from df_mycloud.RAM)
     Output:
         formatted_output : pd.DataFrame = formatted table
     '''
@@ -131,7 +375,9 @@ def format_output(ts, df_item_info, df_tmp_hosts_zabbix, df_cockpit, df_mycloud)
 
     # Find actual server ram
     formatted_output["ram"] = formatted_output.ram/1000
-    formatted_output["ram_server"] = formatted_output.ram.apply(lambda x: find_closest(x, df_mycloud.RAM.unique()))
+    if ram_index is None:
+        ram_index = CatalogueIndex(df_mycloud.RAM.unique())
+    formatted_output["ram_server"] = ram_index.closest(formatted_output.ram)
     formatted_output = formatted_output.drop(["ram"], axis=1)
 
     return formatted_output
\ No newline at end of file
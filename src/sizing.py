@@ -0,0 +1,314 @@
+import heapq
+
+import numpy as np
+import pandas as pd
+
+from src.pricing import CatalogueIndex
+from src.instrument import instrumented
+
+
+CPU_CONFIG = [1, 2, 4, 8, 12, 16]
+RAM_CONFIG = [2, 4, 6, 8, 12, 16, 24, 32, 64, 128]
+# numbers of cpu of the budgeted scenario (no 12 cpu configuration, as in the scenarios notebook)
+CONSTRAINT_CPU_CONFIG = [1, 2, 4, 8, 16]
+
+
+def nearest(values, catalogue):
+    '''
+    Find the closest catalogue value of each value (see pricing.CatalogueIndex).
+
+    On ties, the value appearing first in the catalogue is kept (the smallest one for the
+    sorted configurations), as min(catalogue, key=lambda x: abs(x-value)).
+
+    Args:
+        values : np.array(float) = values to find the closest of
+        catalogue : list(float) = reference values
+    Output:
+        closest : np.array(float) = closest catalogue value of each value
+    '''
+    return CatalogueIndex(catalogue).closest(values).astype(float)
+
+
+def run_lengths(itemids, values, thresholds, above=True):
+    '''
+    Number of consecutive days satisfying the threshold condition, ending at each day, for several thresholds.
+
+    The rows must be sorted by (itemid, date) : runs are counted along the rows, and restart at each item.
+    A day satisfies the condition when threshold <= value (above=True), or value <= threshold (above=False).
+
+    Args:
+        itemids : np.array(int) = itemid of each row
+        values : np.array(float) = usage of each row
+        thresholds : list(float) = thresholds of the condition
+        above : bool = count the days above (True) or under (False) the threshold
+    Output:
+        runs : np.array(int) of shape (len(thresholds), len(values)) = run length ending at each row (0 if the condition is not satisfied)
+    '''
+    itemids = np.asarray(itemids)
+    values = np.asarray(values, dtype=float)
+    thresholds = np.asarray(thresholds, dtype=float).reshape(-1, 1)
+    positions = np.arange(len(values))
+
+    satisfied = (thresholds <= values) if above else (values <= thresholds)
+    item_start = np.r_[True, itemids[1:] != itemids[:-1]][:len(itemids)]
+
+    # last row before the current run : a row out of the condition, or the row before the item
+    run_start = np.where(~satisfied, positions, np.where(item_start, positions - 1, -1))
+    run_start = np.maximum.accumulate(run_start, axis=1)
+
+    return positions - run_start
+
+
+@instrumented()
+def saturation_usage(df_item_trend, thresholds=[99.9], metric="value_avg", above=True):
+    '''
+    Longest saturation streak and usage weighted by the saturation streaks of each item, for several thresholds.
+
+    The usage of each day is multiplied by the length of the streak of saturated days ending at this day
+    (by 1 out of the streaks), and averaged per item : long saturations weigh more in the usage used to size the item.
+
+    Args:
+        df_item_trend : pd.DataFrame([itemid, clock, metric]) = table of the time series
+        thresholds : list(float) = usage percentages from which a day is saturated
+        metric : str = usage column
+        above : bool = count the days above (True) or under (False) the threshold
+    Output:
+        df_usage : pd.DataFrame([itemid, threshold, metric_sdays, sdays_above_threshold]) = one row per item and threshold
+    '''
+    columns = ["itemid", "threshold", metric + "_sdays", "sdays_above_threshold"]
+    if df_item_trend.empty:
+        return pd.DataFrame(columns=columns)
+
+    order = np.lexsort((pd.to_datetime(df_item_trend["clock"]).to_numpy(), df_item_trend["itemid"].to_numpy()))
+    itemids = df_item_trend["itemid"].to_numpy()[order]
+    values = df_item_trend[metric].to_numpy(dtype=float)[order]
+
+    runs = run_lengths(itemids, values, thresholds, above)
+
+    # weighted average (missing usages ignored) and longest streak of each item
+    item_start = np.flatnonzero(np.r_[True, itemids[1:] != itemids[:-1]])
+    n_values = np.add.reduceat(~np.isnan(values), item_start)
+    weighted = np.where(np.isnan(values), 0, values * np.maximum(runs, 1))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        usage = np.add.reduceat(weighted, item_start, axis=1) / n_values
+    longest_run = np.maximum.reduceat(runs, item_start, axis=1)
+
+    return pd.DataFrame(dict(zip(columns, [
+        np.tile(itemids[item_start], len(runs)),
+        np.repeat(np.asarray(thresholds, dtype=float), len(item_start)),
+        usage.ravel(),
+        longest_run.ravel()])))
+
+
+def resize(current, usage_min, usage_max, threshold_min, threshold_max, catalogue):
+    '''
+    New capacity of each item from its usage, snapped on the catalogue.
+
+    An item used above threshold_max is upgraded by a factor ceil(usage_max/threshold_max).
+    Otherwise, an item used under threshold_min is downgraded by a factor round(threshold_min/usage_min).
+    Items with a null (or missing) usage keep their capacity.
+
+    Args:
+        current : np.array(float) = current capacity of each item
+        usage_min : np.array(float) = lowest usage percentage of each item
+        usage_max : np.array(float) = highest usage percentage of each item
+        threshold_min : float = usage percentage under which the item is downgraded
+        threshold_max : float = usage percentage above which the item is upgraded
+        catalogue : list(float) = available capacities
+    Output:
+        new : np.array(float) = new capacity of each item
+    '''
+    current = np.asarray(current, dtype=float)
+    usage_min = np.asarray(usage_min, dtype=float)
+    usage_max = np.asarray(usage_max, dtype=float)
+
+    active = usage_max != 0
+    upgrade = active & (usage_max > threshold_max)
+    downgrade = active & ~upgrade & (usage_min < threshold_min)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio_up = np.ceil(usage_max / threshold_max)
+        # a non positive usage gets the smallest capacity of the catalogue
+        ratio_down = np.where(usage_min > 0, np.round(threshold_min / usage_min), np.inf)
+
+    new = current.copy()
+    new[upgrade] = nearest(current[upgrade] * ratio_up[upgrade], catalogue)
+    new[downgrade] = nearest(current[downgrade] / ratio_down[downgrade], catalogue)
+
+    return new
+
+
+def count_changes(current, new):
+    '''
+    Count the downgraded, unchanged and upgraded items.
+
+    Args:
+        current : np.array(float) = current capacity of each item
+        new : np.array(float) = new capacity of each item
+    Output:
+        counts : tuple(int) = number of downgraded, unchanged and upgraded items
+    '''
+    return int((new < current).sum()), int((new == current).sum()), int((new > current).sum())
+
+
+def _changes(df, current_cpu, new_cpu, current_ram, new_ram, mask):
+    is_cpu = mask & (df["item_type"] == "cpu").to_numpy()
+    is_mem = mask & (df["item_type"] == "mem").to_numpy()
+
+    counts = dict()
+    counts["count_cpu_downgrade"], counts["count_cpu_stay"], counts["count_cpu_upgrade"] = \
+        count_changes(current_cpu[is_cpu], new_cpu[is_cpu])
+    counts["count_ram_downgrade"], counts["count_ram_stay"], counts["count_ram_upgrade"] = \
+        count_changes(current_ram[is_mem], new_ram[is_mem])
+    return counts
+
+
+@instrumented()
+def config_optim(df, threshold_min_cpu=60, threshold_max_cpu=80, threshold_min_ram=70, threshold_max_ram=80,
+    cpu_config=CPU_CONFIG, ram_config=RAM_CONFIG):
+    '''
+    Right-size the cpu and ram of every non periodic item from its usage, all items at once.
+
+    cpu items get a new number of cpu, mem items a new ram capacity, according to their
+    usage weighted by the saturation streaks (value_avg_sdays). Periodic items (season != 0)
+    keep their configuration : they are sized day by day with config_optim_season.
+
+    Args:
+        df : pd.DataFrame([item_type, season, value_avg_sdays, number_cpu, ram]) = table of the items
+        threshold_min_cpu, threshold_max_cpu : float = cpu usage range out of which the cpu is resized
+        threshold_min_ram, threshold_max_ram : float = ram usage range out of which the ram is resized
+        cpu_config : list(int) = available numbers of cpu
+        ram_config : list(int) = available ram capacities (GB)
+    Output:
+        df : pd.DataFrame = table of the items, with new_cpu_optim and new_ram_optim columns
+        counts : dict = number of downgraded, unchanged and upgraded cpu / ram items (non periodic items only)
+    '''
+    usage = df["value_avg_sdays"].to_numpy(dtype=float)
+    cpu = df["number_cpu"].to_numpy(dtype=float)
+    ram = nearest(df["ram"].to_numpy(dtype=float) / 1000, ram_config)
+
+    non_periodic = (df["season"] == 0).to_numpy()
+    resize_cpu = non_periodic & (df["item_type"] == "cpu").to_numpy()
+    resize_ram = non_periodic & (df["item_type"] == "mem").to_numpy()
+
+    new_cpu = np.where(resize_cpu,
+        resize(cpu, usage, usage, threshold_min_cpu, threshold_max_cpu, cpu_config), cpu)
+    new_ram = np.where(resize_ram,
+        resize(ram, usage, usage, threshold_min_ram, threshold_max_ram, ram_config), ram)
+
+    counts = _changes(df, cpu, new_cpu, ram, new_ram, non_periodic)
+    return df.assign(new_cpu_optim=new_cpu, new_ram_optim=new_ram), counts
+
+
+@instrumented()
+def config_constraint(df, threshold_min_cpu=60, threshold_max_cpu=80, threshold_min_ram=70, threshold_max_ram=80,
+    cpu_budget=35, ram_budget=0, cpu_config=CONSTRAINT_CPU_CONFIG, ram_config=RAM_CONFIG):
+    '''
+    Right-size the non periodic items under a cpu and a ram budget.
+
+    Under-used items are first downgraded (see config_optim), and the cpu / ram they free is added to
+    the budgets. The over-used items are then upgraded by decreasing saturation severity (value_avg_sdays,
+    then sdays_above_threshold), popped from a priority queue, as long as the budget of their resource
+    covers the added capacity. An upgrade the budget cannot cover is denied, and the next items are still
+    considered. Periodic items (season != 0) keep their configuration.
+
+    Args:
+        df : pd.DataFrame([item_type, season, value_avg_sdays, sdays_above_threshold, number_cpu, ram]) = table of the items
+        threshold_min_cpu, threshold_max_cpu : float = cpu usage range out of which the cpu is resized
+        threshold_min_ram, threshold_max_ram : float = ram usage range out of which the ram is resized
+        cpu_budget : float = number of cpu available for the upgrades, on top of the freed ones
+        ram_budget : float = ram (GB) available for the upgrades, on top of the freed one
+        cpu_config : list(int) = available numbers of cpu
+        ram_config : list(int) = available ram capacities (GB)
+    Output:
+        df : pd.DataFrame = table of the items, with new_cpu_constraint and new_ram_constraint columns
+        counts : dict = number of downgraded, unchanged and upgraded cpu / ram items (non periodic items only),
+            and the remaining budgets (remaining_cpu, remaining_ram)
+        trace : pd.DataFrame([step, index, item_type, action, current, new, budget]) = every downgrade, upgrade
+            and denied upgrade, in decision order, with the budget of the resource after the decision
+    '''
+    usage = df["value_avg_sdays"].to_numpy(dtype=float)
+    cpu = df["number_cpu"].to_numpy(dtype=float)
+    ram = nearest(df["ram"].to_numpy(dtype=float) / 1000, ram_config)
+
+    non_periodic = (df["season"] == 0).to_numpy()
+    resources = {
+        "cpu": (non_periodic & (df["item_type"] == "cpu").to_numpy(), cpu, threshold_min_cpu, threshold_max_cpu, cpu_config),
+        "mem": (non_periodic & (df["item_type"] == "mem").to_numpy(), ram, threshold_min_ram, threshold_max_ram, ram_config),
+    }
+    budgets = {"cpu": float(cpu_budget), "mem": float(ram_budget)}
+    new = {"cpu": cpu.copy(), "mem": ram.copy()}
+    upgrades = {"cpu": cpu.copy(), "mem": ram.copy()}
+    trace = []
+
+    # downgrades free budget
+    for item_type, (mask, current, threshold_min, threshold_max, config) in resources.items():
+        resized = resize(current, usage, usage, threshold_min, threshold_max, config)
+        downgrade = mask & (resized < current)
+        new[item_type][downgrade] = resized[downgrade]
+        upgrades[item_type] = np.where(mask & (resized > current), resized, current)
+        for index in np.flatnonzero(downgrade):
+            budgets[item_type] += current[index] - resized[index]
+            trace.append((index, item_type, "downgrade", current[index], resized[index], budgets[item_type]))
+
+    # upgrades by decreasing severity, while the budget lasts
+    severity = df["sdays_above_threshold"].to_numpy(dtype=float) if "sdays_above_threshold" in df.columns \
+        else np.zeros(len(df))
+    queue = [(-usage[index], -severity[index], index, item_type)
+        for item_type, (_, current, *_) in resources.items()
+        for index in np.flatnonzero(upgrades[item_type] > current)]
+    heapq.heapify(queue)
+    while queue:
+        _, _, index, item_type = heapq.heappop(queue)
+        current, proposed = resources[item_type][1][index], upgrades[item_type][index]
+        if proposed - current <= budgets[item_type]:
+            budgets[item_type] -= proposed - current
+            new[item_type][index] = proposed
+            trace.append((index, item_type, "upgrade", current, proposed, budgets[item_type]))
+        else:
+            trace.append((index, item_type, "denied", current, proposed, budgets[item_type]))
+
+    counts = _changes(df, cpu, new["cpu"], ram, new["mem"], non_periodic)
+    counts["remaining_cpu"], counts["remaining_ram"] = budgets["cpu"], budgets["mem"]
+
+    trace = pd.DataFrame(trace, columns=["index", "item_type", "action", "current", "new", "budget"])
+    trace.insert(0, "step", np.arange(len(trace)))
+    trace["index"] = df.index[trace["index"].to_numpy(dtype=int)]
+
+    return df.assign(new_cpu_constraint=new["cpu"], new_ram_constraint=new["mem"]), counts, trace
+
+
+@instrumented()
+def config_optim_season(df, threshold_min_cpu=60, threshold_max_cpu=80, threshold_min_ram=70, threshold_max_ram=80,
+    cpu_config=CPU_CONFIG, ram_config=RAM_CONFIG):
+    '''
+    Right-size the cpu and ram of periodic items day by day, from their cleaned time-series.
+
+    Each row is one day of one item : the upper bound of the seasonal forecast (yhat_upper)
+    drives the upgrades, its lower bound (yhat_lower) the downgrades.
+
+    Args:
+        df : pd.DataFrame([item_type, yhat_lower, yhat_upper, number_cpu, ram_server]) = table of the time-series
+        threshold_min_cpu, threshold_max_cpu : float = cpu usage range out of which the cpu is resized
+        threshold_min_ram, threshold_max_ram : float = ram usage range out of which the ram is resized
+        cpu_config : list(int) = available numbers of cpu
+        ram_config : list(int) = available ram capacities (GB)
+    Output:
+        df : pd.DataFrame = table of the time-series, with new_cpu_optim and new_ram_optim columns
+        counts : dict = number of downgraded, unchanged and upgraded cpu / ram rows
+    '''
+    usage_min = df["yhat_lower"].to_numpy(dtype=float)
+    usage_max = df["yhat_upper"].to_numpy(dtype=float)
+    cpu = df["number_cpu"].to_numpy(dtype=float)
+    ram = df["ram_server"].to_numpy(dtype=float)
+
+    resize_cpu = (df["item_type"] == "cpu").to_numpy()
+    resize_ram = (df["item_type"] == "mem").to_numpy()
+
+    new_cpu = np.where(resize_cpu,
+        resize(cpu, usage_min, usage_max, threshold_min_cpu, threshold_max_cpu, cpu_config), cpu)
+    new_ram = np.where(resize_ram,
+        resize(ram, usage_min, usage_max, threshold_min_ram, threshold_max_ram, ram_config), ram)
+
+    counts = _changes(df, cpu, new_cpu, ram, new_ram, np.ones(len(df), dtype=bool))
+    return df.assign(new_cpu_optim=new_cpu, new_ram_optim=new_ram), counts
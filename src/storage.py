@@ -0,0 +1,318 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+
+PARTITION_COLUMN = "month"
+
+# Fingerprint of the csv a store was built from (ignored by the Parquet readers, as its name starts with '_')
+SOURCE_FILE = "_source.json"
+
+# Compact dtypes of the extraction tables columns (see compact_table)
+SCHEMA = {
+    # ids
+    "itemid": "int32",
+    "hostid": "int32",
+    # usage percentages
+    "value_min": "float32",
+    "value_avg": "float32",
+    "value_max": "float32",
+    # server configurations and catalogue
+    "ram": "int32",
+    "number_cpu": "int16",
+    "number_core": "int16",
+    "RAM": "int16",
+    "CPU": "int16",
+    "Price": "float32",
+    # low-cardinality strings
+    "item_type": "category",
+    "name_server": "category",
+    "host": "category",
+    "country": "category",
+    "mycloud": "category",
+    "type_cpu": "category",
+    "iua": "category",
+    "key": "category",
+}
+
+
+def compact_table(df, schema=SCHEMA):
+    '''
+    Convert the columns of a table to their compact dtypes.
+
+    Integer columns with missing values are converted to float32 instead, and columns that do
+    not fit their integer dtype are left unchanged, as well as string columns with mostly distinct
+    values. Dates keep their datetime64 dtype, which the downstream functions rely on.
+    The csv index column ('Unnamed: 0') is dropped.
+
+    Args:
+        df : pd.DataFrame = table to convert
+        schema : dict(str: str) = compact dtype of each column (columns not in the schema are left unchanged)
+    Output:
+        df : pd.DataFrame = table with compact dtypes
+    '''
+    df = df.drop(columns=['Unnamed: 0'], errors='ignore')
+
+    dtypes = dict()
+    for col in df.columns.intersection(list(schema)):
+        dtype = schema[col]
+        if dtype.startswith("int"):
+            values = df[col]
+            if values.isna().any():
+                dtype = "float32"
+            elif not len(values) or not pd.api.types.is_numeric_dtype(values) \
+                or values.min() < np.iinfo(dtype).min or values.max() > np.iinfo(dtype).max:
+                continue
+        # a category only saves memory on repeated values (ex: name_server in the time-series, not in cockpit)
+        elif dtype == "category" and df[col].nunique() > len(df) / 2:
+            continue
+        dtypes[col] = dtype
+
+    return df.astype(dtypes)
+
+
+def memory_report(tables):
+    '''
+    Measure the memory saved by the compact dtypes on each table.
+
+    Args:
+        tables : dict(str: pd.DataFrame) = tables loaded with the default dtypes, by name
+    Output:
+        report : pd.DataFrame([default_mb, compact_mb, saving]) = memory of each table before and after compact_table
+    '''
+    report = pd.DataFrame(
+        [(name, df.memory_usage(deep=True).sum(), compact_table(df).memory_usage(deep=True).sum())
+         for name, df in tables.items()],
+        columns=["table", "default_mb", "compact_mb"]).set_index("table") / 1e6
+    report["saving"] = 1 - report.compact_mb / report.default_mb
+
+    return report
+
+
+def default_store_path(csv_path):
+    '''
+    Path of the columnar store associated to a raw extraction csv.
+
+    Args:
+        csv_path : str = path of the raw csv (ex: data/item_trend_20221221.csv)
+    Output:
+        store_path : str = path of the store (ex: data/item_trend_20221221.parquet)
+    '''
+    return os.path.splitext(csv_path)[0] + ".parquet"
+
+
+def is_store(path):
+    '''
+    Check whether a path points to a columnar (Parquet) store rather than a raw csv.
+    '''
+    return os.path.isdir(path) or str(path).endswith(".parquet")
+
+
+def _write_partitions(df, store_path, date_column):
+    df[date_column] = pd.to_datetime(df[date_column], format='%Y-%m-%d')
+    sort_columns = [col for col in ["itemid", date_column] if col in df.columns]
+    df = df.sort_values(sort_columns, kind="stable", ignore_index=True)
+
+    df[PARTITION_COLUMN] = df[date_column].dt.strftime('%Y-%m')
+    df.to_parquet(store_path, engine="pyarrow", partition_cols=[PARTITION_COLUMN], index=False)
+
+
+def source_fingerprint(csv_path):
+    '''
+    Fingerprint of a raw extraction csv : its size and modification time.
+    '''
+    stat = os.stat(csv_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def is_stale(csv_path, store_path):
+    '''
+    Check whether a store no longer matches its csv (ex: a new extraction written to the same file name).
+
+    The store is compared to the csv fingerprint recorded when it was built, or, for a store without
+    one, to the csv modification time. A store whose csv does not exist is never stale.
+
+    Args:
+        csv_path : str = path of the raw csv extraction
+        store_path : str = path of the store built from it
+    Output:
+        stale : bool = the store must be rebuilt
+    '''
+    if not os.path.exists(csv_path):
+        return False
+    source_path = os.path.join(store_path, SOURCE_FILE)
+    if os.path.isfile(source_path):
+        with open(source_path) as file:
+            return json.load(file) != source_fingerprint(csv_path)
+    return os.stat(csv_path).st_mtime_ns > os.stat(store_path).st_mtime_ns
+
+
+def _csv_dtypes(csv_path, chunksize):
+    # dtypes of a csv read at once, from its chunks : a column takes the common dtype of its chunks
+    # (ex: float when a later chunk has missing values in a column of integers)
+    dtypes = None
+    for chunk in pd.read_csv(csv_path, chunksize=chunksize):
+        dtypes = chunk.dtypes if dtypes is None else \
+            pd.Series({col: np.result_type(dtype, chunk[col].dtype) for col, dtype in dtypes.items()})
+    return dtypes
+
+
+def build_store(csv_path, store_path=None, date_column="clock", overwrite=False, chunksize=None):
+    '''
+    Convert a raw extraction csv once into a typed columnar store.
+
+    The table is written as a Parquet dataset partitioned by month of `date_column`,
+    and sorted by (itemid, date) so that each row group covers a narrow range of itemids.
+    Itemid and date predicates of load_table can then skip whole files and row groups.
+    If the store already exists, it is reused, unless overwrite=True or the csv changed since
+    the store was built (see is_stale).
+
+    With chunksize, the csv is converted chunk by chunk with a bounded memory : each chunk adds
+    its own files to the month partitions, and is only sorted within itself. The csv is then read
+    twice, first to find the dtypes shared by all the chunks.
+
+    The store is written to a temporary directory, moved to store_path once complete : a failed
+    conversion leaves no partial store.
+
+    Args:
+        csv_path : str = path of the raw csv extraction
+        store_path : str = path of the store to create (default : csv path with a .parquet suffix)
+        date_column : str = date column, parsed once and used for partitioning
+        overwrite : bool = rebuild the store even if it is up to date
+        chunksize : int = number of csv rows converted at once (default : the whole csv)
+    Output:
+        store_path : str = path of the store
+    '''
+    if store_path is None:
+        store_path = default_store_path(csv_path)
+    if os.path.exists(store_path) and not overwrite and not is_stale(csv_path, store_path):
+        return store_path
+
+    # fingerprint taken before the conversion : a csv rewritten meanwhile makes the store stale
+    source = source_fingerprint(csv_path)
+    tmp_path = f"{store_path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    try:
+        if chunksize is None:
+            _write_partitions(pd.read_csv(csv_path).drop(columns=['Unnamed: 0'], errors='ignore'), tmp_path, date_column)
+        else:
+            # all the files of the store share the dtypes of the whole csv
+            dtypes = _csv_dtypes(csv_path, chunksize).to_dict()
+            for chunk in pd.read_csv(csv_path, chunksize=chunksize, dtype=dtypes):
+                _write_partitions(chunk.drop(columns=['Unnamed: 0'], errors='ignore'), tmp_path, date_column)
+        with open(os.path.join(tmp_path, SOURCE_FILE), "w") as file:
+            json.dump(source, file)
+    except BaseException:
+        shutil.rmtree(tmp_path)
+        raise
+
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path) if os.path.isdir(store_path) else os.remove(store_path)
+    os.replace(tmp_path, store_path)
+    return store_path
+
+
+def iter_months(path, columns=None, itemids=None, date_column="clock", compact=False):
+    '''
+    Load a table month by month, to process a large table with a bounded memory.
+
+    Each month of a store is read from its own partition (see load_table). A csv has no partitions :
+    it is loaded at once, as a single chunk.
+
+    Args:
+        path : str = path of the store (see build_store) or of a csv file
+        columns : list(str) = columns to load (default : all columns)
+        itemids : list(int) = itemids to keep (default : all items)
+        date_column : str = name of the date column the store is partitioned on
+        compact : bool = convert the columns to their compact dtypes (see compact_table)
+    Output:
+        chunks : generator(pd.DataFrame) = rows of each month, in chronological order
+    '''
+    if not os.path.isdir(path):
+        yield load_table(path, columns=columns, itemids=itemids, date_column=date_column, compact=compact)
+        return
+
+    months = sorted(entry.name.split("=", 1)[1] for entry in os.scandir(path)
+        if entry.is_dir() and entry.name.startswith(f"{PARTITION_COLUMN}="))
+    for month in months:
+        start_date = pd.Timestamp(f"{month}-01")
+        end_date = start_date + pd.offsets.MonthEnd(0)
+        yield load_table(path, columns=columns, itemids=itemids, start_date=start_date, end_date=end_date,
+            date_column=date_column, compact=compact)
+
+
+def load_table(path, columns=None, itemids=None, start_date=None, end_date=None, date_column="clock",
+    compact=False, **read_csv_kwargs):
+    '''
+    Load a table from a columnar store or, as a fallback, from a raw csv.
+
+    Column projection and itemid/date-range predicates are pushed down to the store,
+    so that only the needed partitions, row groups and columns are read.
+    The date column is returned as datetime and the csv index column ('Unnamed: 0') is dropped.
+
+    Args:
+        path : str = path of the store (see build_store) or of a csv file
+        columns : list(str) = columns to load (default : all columns)
+        itemids : list(int) = itemids to keep (default : all items)
+        start_date : str or datetime = first date to keep, included (default : no lower bound)
+        end_date : str or datetime = last date to keep, included (default : no upper bound)
+        date_column : str = name of the date column the date range applies to
+        compact : bool = convert the columns to their compact dtypes (see compact_table)
+        read_csv_kwargs : dict = extra arguments passed to pd.read_csv (csv fallback only)
+    Output:
+        df : pd.DataFrame = loaded table
+    '''
+    if compact and not is_store(path):
+        # strings and floats are parsed directly into their compact dtypes (integers may have missing values)
+        read_csv_kwargs.setdefault("dtype", {col: dtype for col, dtype in SCHEMA.items() if not dtype.startswith("int")})
+    df = _load_table(path, columns, itemids, start_date, end_date, date_column, **read_csv_kwargs)
+
+    return compact_table(df) if compact else df
+
+
+def _load_table(path, columns, itemids, start_date, end_date, date_column, **read_csv_kwargs):
+    start_date = None if start_date is None else pd.Timestamp(start_date)
+    end_date = None if end_date is None else pd.Timestamp(end_date)
+
+    if is_store(path):
+        filters = []
+        if itemids is not None:
+            filters.append(("itemid", "in", list(itemids)))
+        if start_date is not None:
+            filters.append((PARTITION_COLUMN, ">=", start_date.strftime('%Y-%m')))
+            filters.append((date_column, ">=", start_date))
+        if end_date is not None:
+            filters.append((PARTITION_COLUMN, "<=", end_date.strftime('%Y-%m')))
+            filters.append((date_column, "<=", end_date))
+
+        df = pd.read_parquet(path, engine="pyarrow", columns=columns, filters=filters or None)
+        df = df.drop(columns=[PARTITION_COLUMN], errors='ignore')
+        if "itemid" not in df.columns or date_column not in df.columns:
+            return df
+        # partitions are read month by month : restore the (itemid, date) order
+        return df.sort_values(["itemid", date_column], kind="stable", ignore_index=True)
+
+    usecols = None
+    if columns is not None:
+        usecols = list(columns)
+        usecols += [col for col in ["itemid", date_column] if col not in usecols]
+    df = pd.read_csv(path, usecols=lambda col: usecols is None or col in usecols, **read_csv_kwargs)
+    df = df.drop(columns=['Unnamed: 0'], errors='ignore')
+
+    mask = pd.Series(True, index=df.index)
+    if date_column in df.columns:
+        df[date_column] = pd.to_datetime(df[date_column])
+        if start_date is not None:
+            mask &= df[date_column] >= start_date
+        if end_date is not None:
+            mask &= df[date_column] <= end_date
+    if itemids is not None and "itemid" in df.columns:
+        mask &= df["itemid"].isin(itemids)
+    df = df.loc[mask]
+
+    if columns is not None:
+        df = df[list(columns)]
+    return df
@@ -0,0 +1,113 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+RAM_SIZES = [2048, 4096, 8192, 16384, 32768, 65536]
+CPU_SIZES = [1, 2, 4, 8, 12, 16]
+CATALOGUE_RAM = [2, 4, 6, 8, 12, 16, 24, 32, 64, 128]
+
+
+def synthetic_fleet(n_servers=100, n_days=365, end_date="2022-12-20", min_days=60, weekly_share=0.3,
+    monthly_share=0.1, n_applications=None, seed=0):
+    '''
+    Generate synthetic extraction tables with the schema of the real ones, to measure the pipeline at any scale.
+
+    Each server has one cpu and one mem item. The daily usage of an item is a base level, with a
+    weekly (period 7) and / or a monthly (period 30.5) seasonality for a share of the items, noise
+    and a few saturation bursts. Histories have random lengths, between min_days and n_days days.
+
+    Args:
+        n_servers : int = number of servers (twice as many items)
+        n_days : int = longest history, in days
+        end_date : str = last day of the histories
+        min_days : int = shortest history, in days
+        weekly_share : float = share of the items with a weekly seasonality
+        monthly_share : float = share of the items with a monthly seasonality
+        n_applications : int = number of applications, shared by the servers in cockpit (default : n_servers // 2)
+        seed : int = seed of the random generator
+    Output:
+        tables : dict(str: pd.DataFrame) = cockpit, tmp_hosts_zabbix, item_info, item_trend, mycloud tables,
+            and itemid_and_periods, the injected seasonality periods of each item
+    '''
+    rng = np.random.default_rng(seed)
+    names = np.array([f"SRV{index:06d}" for index in range(n_servers)])
+    n_applications = max(n_applications or n_servers // 2, 1)
+
+    # applications share servers : one cockpit row per (application, server)
+    n_rows = n_servers + n_servers // 4
+    servers = np.r_[np.arange(n_servers), rng.integers(0, n_servers, n_rows - n_servers)]
+    ram = rng.choice(RAM_SIZES, n_servers, p=[.1, .2, .3, .2, .15, .05])
+    number_cpu = rng.choice(CPU_SIZES, n_servers, p=[.15, .3, .3, .15, .05, .05])
+    cockpit = pd.DataFrame({
+        "name_server": names[servers], "country": "FRANCE",
+        "ram": ram[servers], "number_cpu": number_cpu[servers], "number_core": number_cpu[servers] * 2,
+        "type_cpu": "INTEL", "mycloud": rng.choice(["Yes", "No"], n_servers, p=[.9, .1])[servers],
+        "iua": [f"APP{index:05d}" for index in rng.integers(0, n_applications, n_rows)]})
+
+    tmp_hosts_zabbix = pd.DataFrame({"hostid": np.arange(n_servers) + 10_000, "host": np.char.lower(names)})
+
+    n_items = 2 * n_servers
+    item_info = pd.DataFrame({"itemid": np.arange(n_items) + 100_000,
+        "hostid": np.repeat(tmp_hosts_zabbix.hostid.to_numpy(), 2),
+        "item_type": np.tile(["cpu", "mem"], n_servers)})
+
+    # seasonalities
+    weekly = rng.random(n_items) < weekly_share
+    monthly = rng.random(n_items) < monthly_share
+    itemid_and_periods = pd.DataFrame({"itemid": item_info.itemid,
+        "period1": np.where(weekly, 7, np.where(monthly, 30, np.nan)),
+        "period2": np.where(weekly & monthly, 30, np.nan)})
+
+    # daily usage of every item on the longest history, then cut to the history of each item
+    day = np.arange(n_days)
+    base = rng.uniform(5, 70, (n_items, 1))
+    usage = base + rng.normal(0, 3, (n_items, n_days))
+    usage += np.where(weekly, rng.uniform(5, 20, n_items), 0)[:, None]\
+        * np.sin(2 * np.pi * (day + rng.integers(0, 7, (n_items, 1))) / 7)
+    usage += np.where(monthly, rng.uniform(5, 20, n_items), 0)[:, None]\
+        * np.sin(2 * np.pi * (day + rng.integers(0, 30, (n_items, 1))) / 30.5)
+    bursts = rng.random((n_items, n_days)) < 0.01
+    usage = np.clip(np.where(bursts, 100, usage), 0, 100)
+
+    n_item_days = rng.integers(min(min_days, n_days), n_days + 1, n_items)
+    kept = day[None, :] >= (n_days - n_item_days)[:, None]
+    item, item_day = np.nonzero(kept)
+    value_avg = usage[item, item_day]
+    dates = pd.date_range(end=end_date, periods=n_days)
+
+    item_trend = pd.DataFrame({"itemid": item_info.itemid.to_numpy()[item],
+        "clock": np.asarray(dates.strftime('%Y-%m-%d'))[item_day],
+        "value_min": np.clip(value_avg - rng.uniform(0, 10, len(item)), 0, 100),
+        "value_avg": value_avg,
+        "value_max": np.clip(value_avg + rng.uniform(0, 25, len(item)), 0, 100),
+        "item_type": item_info.item_type.to_numpy()[item]})
+    # extractions are not sorted
+    item_trend = item_trend.iloc[rng.permutation(len(item_trend))].reset_index(drop=True)
+
+    mycloud = pd.DataFrame([(cpu, ram_size) for cpu in CPU_SIZES for ram_size in CATALOGUE_RAM], columns=["CPU", "RAM"])
+    mycloud["Price"] = (90 * mycloud.CPU + 25 * mycloud.RAM + 100).astype(float)
+    mycloud["key"] = mycloud.CPU.astype(str) + "#" + mycloud.RAM.astype(str)
+
+    return {"cockpit": cockpit, "tmp_hosts_zabbix": tmp_hosts_zabbix, "item_info": item_info,
+        "item_trend": item_trend, "mycloud": mycloud, "itemid_and_periods": itemid_and_periods}
+
+
+def write_fleet(tables, directory, suffix="20221221"):
+    '''
+    Write synthetic tables as extraction csv files (ex: directory/item_trend_20221221.csv).
+
+    Args:
+        tables : dict(str: pd.DataFrame) = tables, by name (see synthetic_fleet)
+        directory : str = directory of the files (created if needed)
+        suffix : str = extraction date of the file names
+    Output:
+        paths : dict(str: str) = path of each table
+    '''
+    os.makedirs(directory, exist_ok=True)
+    paths = dict()
+    for name, df in tables.items():
+        paths[name] = os.path.join(directory, f"{name}_{suffix}.csv")
+        df.to_csv(paths[name])
+    return paths
@@ -4,25 +4,61 @@ import numpy as np
 from statsmodels.graphics.tsaplots import pacf, acf
 
 
+def _n_last_days_positions(df_item_trend, nLastDays, metric=None):
+    # one sort pass on (itemid, clock) : each item becomes a contiguous segment
+    itemids = df_item_trend["itemid"].to_numpy()
+    order = np.lexsort((pd.to_datetime(df_item_trend["clock"]).to_numpy(), itemids))
+    sorted_itemids = itemids[order]
+    if len(order) == 0:
+        return order, sorted_itemids
+
+    # segment offsets of each item in the sorted arrays
+    starts = np.flatnonzero(np.r_[True, sorted_itemids[1:] != sorted_itemids[:-1]])
+    ends = np.r_[starts[1:], len(order)]
+
+    # keep the tail window of each segment (its nLastDays latest clocks)
+    rank_from_end = np.repeat(ends, ends - starts) - np.arange(len(order)) - 1
+    in_window = rank_from_end < nLastDays
+
+    # without metric, all items are kept (even those with less than nLastDays occurrences)
+    if metric is None:
+        return order[in_window], sorted_itemids[starts]
+
+    # removing items with less than nLastDays non-null occurrences in their window
+    valid = in_window & df_item_trend[metric].notna().to_numpy()[order]
+    count_by_item = np.add.reduceat(valid, starts)
+    item_to_keep = count_by_item >= nLastDays
+
+    positions = order[in_window & np.repeat(item_to_keep, ends - starts)]
+    return positions, sorted_itemids[starts][item_to_keep]
+
+
 def keep_n_last_days(df_item_trend, nLastDays, metric):
     # convert clock to datetime
     df_item_trend["clock"] = pd.to_datetime(df_item_trend["clock"])
 
-    # get index values to keep only last n occurrences for each item
-    nLastDays_index_values = df_item_trend\
-        .groupby("itemid")["clock"]\
-        .nlargest(nLastDays)\
-        .reset_index()["level_1"]
+    # positions of the last nLastDays occurrences of each complete item
+    positions, _ = _n_last_days_positions(df_item_trend, nLastDays, metric)
+
+    # keep the original row order
+    return df_item_trend.iloc[np.sort(positions)]
+
+
+def last_days_window(df_item_trend, nLastDays):
+    # last nLastDays occurrences of every item, sorted by itemid and clock
+    # unlike keep_n_last_days, items with less than nLastDays occurrences are kept whole
+    positions, _ = _n_last_days_positions(df_item_trend, nLastDays)
 
-    # keep only last nLastOccurrences occurrences for each item
-    df_nLastDays = df_item_trend.loc[df_item_trend.index.isin(nLastDays_index_values)]
+    return df_item_trend.iloc[positions]
 
-    # removing items with less than nLastDays occurrences
-    count_by_item = df_nLastDays.groupby("itemid")[metric].count()
-    itemid_to_keep = np.array(count_by_item.where(count_by_item >= 95).dropna().index)
-    df_nLastDays = df_nLastDays.loc[df_nLastDays["itemid"].isin(itemid_to_keep)]
 
-    return df_nLastDays
+def n_last_days_matrix(df_item_trend, nLastDays, metric):
+    # dense (items x nLastDays) matrix of metric values, one row per item sorted by clock
+    # returns the itemids of each row along with the matrix
+    positions, itemids = _n_last_days_positions(df_item_trend, nLastDays, metric)
+    matrix = df_item_trend[metric].to_numpy(dtype=float)[positions].reshape(len(itemids), nLastDays)
+
+    return itemids, matrix
 
 
 def get_most_significant_periods_acf(timeSeries, n_largest=5, remove_n_first_lags=3):
@@ -33,6 +69,30 @@ def get_most_significant_periods_acf(timeSeries, n_largest=5, remove_n_first_lag
     return list(zip(np.argsort(-acf_)[:n_largest]+remove_n_first_lags, acf_[np.argsort(-acf_)][:n_largest]))
 
 
+def batched_acf(matrix, nlags=35):
+    # acf coefficients of every row of an (items x days) matrix, computed in one FFT pass
+    # matches statsmodels acf (demeaned, non adjusted) ; constant rows get NaN coefficients
+    n_days = matrix.shape[1]
+    demeaned = matrix - matrix.mean(axis=1, keepdims=True)
+
+    # zero padding to avoid circular correlation
+    n_fft = 1 << int(np.ceil(np.log2(2 * n_days - 1)))
+    spectrum = np.fft.rfft(demeaned, n=n_fft, axis=1)
+    autocov = np.fft.irfft(spectrum * np.conj(spectrum), n=n_fft, axis=1)[:, :nlags + 1] / n_days
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return autocov / autocov[:, :1]
+
+
+def get_most_significant_periods_acf_batch(matrix, n_largest=5, remove_n_first_lags=3, nlags=35):
+    # batched version of get_most_significant_periods_acf, for every row of an (items x days) matrix
+    # returns two (items x n_largest) arrays : the most significant lags and their acf coefficients
+    acf_ = batched_acf(matrix, nlags)[:, remove_n_first_lags:]
+
+    order = np.argsort(-acf_, axis=1, kind="stable")[:, :n_largest]
+    return order + remove_n_first_lags, np.take_along_axis(acf_, order, axis=1)
+
+
 def get_most_significant_periods_pacf(series, n_largest=5, remove_n_first_lags=3):
     if len(series.unique())==1:  # if there is only one distinct value, pacf cannot run
         return np.NaN
@@ -44,6 +104,62 @@ def get_most_significant_periods_pacf(series, n_largest=5, remove_n_first_lags=3
     return list(zip(np.argsort(-pacf_)[:n_largest]+remove_n_first_lags, pacf_[np.argsort(-pacf_)][:n_largest]))
 
 
+def batched_pacf(matrix, nlags=35):
+    # pacf coefficients of every row of an (items x days) matrix
+    # Durbin-Levinson recursion on the adjusted autocovariances, run for all rows at once
+    # matches statsmodels pacf (method "ywadjusted") ; constant rows get NaN coefficients
+    n_items, n_days = matrix.shape
+    constant = np.all(matrix == matrix[:, :1], axis=1)
+
+    # adjusted autocovariances (denominator n_days - lag), through one FFT pass
+    demeaned = matrix - matrix.mean(axis=1, keepdims=True)
+    n_fft = 1 << int(np.ceil(np.log2(2 * n_days - 1)))
+    spectrum = np.fft.rfft(demeaned, n=n_fft, axis=1)
+    autocov = np.fft.irfft(spectrum * np.conj(spectrum), n=n_fft, axis=1)[:, :nlags + 1]
+    autocov /= n_days - np.arange(nlags + 1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rho = autocov / autocov[:, :1]
+
+    pacf_ = np.ones((n_items, nlags + 1))
+    phi = np.zeros((n_items, 0))
+    for k in range(1, nlags + 1):
+        # phi holds the order k-1 Yule-Walker coefficients of every row
+        numerator = rho[:, k] - np.sum(phi * rho[:, k - 1:0:-1], axis=1)
+        denominator = 1 - np.sum(phi * rho[:, 1:k], axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            phi_kk = numerator / denominator
+        phi = np.column_stack([phi - phi_kk[:, None] * phi[:, ::-1], phi_kk])
+        pacf_[:, k] = phi_kk
+
+    pacf_[constant] = np.nan
+    return pacf_
+
+
+def get_most_significant_periods_pacf_batch(matrix, n_largest=5, remove_n_first_lags=3, nlags=35):
+    # batched version of get_most_significant_periods_pacf, for every row of an (items x days) matrix
+    # returns two (items x n_largest) arrays : the most significant lags and their pacf coefficients
+    # constant rows, where pacf cannot run, get NaN coefficients
+    pacf_ = batched_pacf(matrix, nlags)[:, remove_n_first_lags:]
+
+    order = np.argsort(-pacf_, axis=1, kind="stable")[:, :n_largest]
+    return order + remove_n_first_lags, np.take_along_axis(pacf_, order, axis=1)
+
+
+def get_most_significant_period_batch(acf_lags, acf_coefs, pacf_lags, pacf_coefs, acf_threshold, pacf_threshold):
+    # batched version of get_most_significant_period, on the arrays returned by the batched acf / pacf functions
+    # for each row, keeps the first acf lag above acf_threshold that is also a pacf lag above pacf_threshold
+    # returns an array of periods, NaN when there is no significant common value between acf and pacf
+    in_pacf = (acf_lags[:, :, None] == pacf_lags[:, None, :]) & (pacf_coefs[:, None, :] > pacf_threshold)
+    significant = (acf_coefs > acf_threshold) & in_pacf.any(axis=2)
+
+    first = significant.argmax(axis=1)
+    periods = acf_lags[np.arange(len(acf_lags)), first].astype(float)
+    periods[~significant.any(axis=1)] = np.nan
+
+    return periods
+
+
 def get_most_significant_period(acf_autocorr, pacf_autocorr, acf_threshold, pacf_threshold):
     # loops through the acf values that are above acf_threshold
     # if the value is also in pacf values, and is above pacf_threshold
@@ -1,38 +1,70 @@
 import pandas as pd
 
-def cleaning_data(cockpit, zabbix, item_trend, item_info):
+from src.instrument import instrumented, stage
+
+
+def dimension_table(cockpit, zabbix, item_info):
     '''
     Input :
             - cockpit    : Dataframe
             - zabbix     : Dataframe
-            - item_trend : Dataframe
             - item_info  : Dataframe
-    
-    Output : Gathers relevant information from the four raw tables and operates some cleaning 
+
+    Output : Server information of each item (cockpit, zabbix and item info gathered once),
+             to be joined to the daily usage (see join_trend).
     '''
     # Pass Server name in uppercase
-    zabbix['host'] = zabbix['host'].str.upper() 
-
-    # Change date type.
-    item_trend['clock'] = pd.to_datetime(item_trend['clock'], format='%Y-%m-%d')
+    zabbix = zabbix.assign(host=zabbix['host'].str.upper())
 
     # Keep relevant columns
     df = cockpit[['name_server', 'country', 'ram', 'number_cpu']]
 
     # Merge with Zabbix on Server Name
-    df = df.merge(zabbix, how='inner', left_on='name_server', right_on='host').drop(columns=['Unnamed: 0', 'host'])
+    df = df.merge(zabbix, how='inner', left_on='name_server', right_on='host').drop(columns=['Unnamed: 0', 'host'], errors='ignore')
 
     # Merge with Item Info
-    df = df.merge(item_info, how='inner').drop(columns=['Unnamed: 0'])
+    df = df.merge(item_info, how='inner').drop(columns=['Unnamed: 0'], errors='ignore')
+
+    return df
+
+
+def join_trend(dimensions, item_trend):
+    '''
+    Input :
+            - dimensions : Dataframe from dimension_table
+            - item_trend : Dataframe (the whole table or a chunk of it)
+
+    Output : Daily usage of the items with the information of their server.
+    '''
+    item_trend = item_trend.assign(clock=pd.to_datetime(item_trend['clock'], format='%Y-%m-%d'))
 
     # Add saturation info per day
-    df = df.merge(item_trend, how ='inner', on='itemid')\
-            .drop(columns=['Unnamed: 0', 'item_type_x', 'hostid', 'itemid'])\
+    df = dimensions.merge(item_trend, how ='inner', on='itemid')\
+            .drop(columns=['Unnamed: 0', 'item_type_x', 'hostid', 'itemid'], errors='ignore')\
             .rename(columns={'item_type_y': 'item_type'})
 
     return df
 
 
+def cleaning_data(cockpit, zabbix, item_trend, item_info):
+    '''
+    Input :
+            - cockpit    : Dataframe
+            - zabbix     : Dataframe
+            - item_trend : Dataframe
+            - item_info  : Dataframe
+    
+    Output : Gathers relevant information from the four raw tables and operates some cleaning 
+    '''
+    # Pass Server name in uppercase
+    zabbix['host'] = zabbix['host'].str.upper() 
+
+    # Change date type.
+    item_trend['clock'] = pd.to_datetime(item_trend['clock'], format='%Y-%m-%d')
+
+    return join_trend(dimension_table(cockpit, zabbix, item_info), item_trend)
+
+
 
 def cpu_kwh(df, min_power=140, max_power=250, pue=1.5, hours=24):
     '''
@@ -89,4 +121,127 @@ def final_table(cpu, ram):
     final['Total Power consumption'] = final['power_consumption_cpu'] + final['power_consumption_ram']
     final['Global emission']         = final['emission_ram'] + final['emission_cpu']    
 
-    return final
\ No newline at end of file
+    return final
+
+@instrumented()
+def emission_table(cockpit, zabbix, item_trend, item_info):
+    '''
+    Input :
+            - cockpit    : Dataframe
+            - zabbix     : Dataframe
+            - item_trend : Dataframe
+            - item_info  : Dataframe
+
+    Output : Power consumption and emission per server per day (cleaning, cpu/ram split and final table).
+    '''
+    return server_emissions(cleaning_data(cockpit, zabbix, item_trend, item_info))
+
+
+def server_emissions(df):
+    '''
+    Input :
+            - df: cleaned dataframe from cleaning_data (or join_trend)
+
+    Output : Power consumption and emission per server per day (cpu/ram split and final table).
+    '''
+    # Create CPU and RAM Dataframes
+    cpu = df[df['item_type'] == 'cpu'].reset_index()
+    ram = df[df['item_type'] == 'mem'].reset_index()
+
+    # Compute Power consumption for CPUs and Memory
+    cpu = cpu.assign(power_consumption_cpu = lambda x: cpu_kwh(df=cpu))
+    ram = ram.assign(power_consumption_ram = lambda x: ram_kwh(df=ram))
+
+    # Compute Gas Emissions est. for CPUs and memory
+    cpu = cpu.assign(emission_cpu = lambda x: ghg_emission(power=x.power_consumption_cpu))
+    ram = ram.assign(emission_ram = lambda x: ghg_emission(power=x.power_consumption_ram))
+
+    # Get final table
+    return final_table(cpu, ram)
+
+
+SUM_COLUMNS = ['power_consumption_cpu', 'emission_cpu', 'power_consumption_ram', 'emission_ram',
+               'Total Power consumption', 'Global emission']
+MEAN_COLUMNS = ['value_avg', 'value_min', 'value_max']
+
+
+def clock_aggregates(final, by='clock'):
+    '''
+    Input :
+            - final: Dataframe from final_table
+            - by: column to aggregate on ('clock', or 'name_server' for aggregates per server)
+
+    Output : Running aggregates per clock (sums of power, emission and usage columns, number of non-missing
+             values of each usage column, ex: count_value_avg).
+             Aggregates of several tables are combined by adding them (see global_insights_table).
+    '''
+    # observed : a categorical server column only aggregates the servers present in the table
+    grouped = final.groupby(by, observed=True)
+    aggregates = grouped[SUM_COLUMNS + MEAN_COLUMNS].sum()
+    # the mean of a usage column skips its missing values (as groupby().mean()) : each one has its own count
+    aggregates = aggregates.join(grouped[MEAN_COLUMNS].count().add_prefix('count_'))
+
+    return aggregates
+
+
+def add_aggregates(aggregates, new_aggregates):
+    '''
+    Input :
+            - aggregates: Dataframe from clock_aggregates (None if nothing is aggregated yet)
+            - new_aggregates: Dataframe from clock_aggregates
+
+    Output : Sum of both aggregates, on the union of their clocks (or servers).
+    '''
+    if aggregates is None:
+        return new_aggregates
+
+    return aggregates.add(new_aggregates, fill_value=0)
+
+
+def global_insights_table(aggregates):
+    '''
+    Input :
+            - aggregates: Dataframe from clock_aggregates (or a sum of them)
+
+    Output : Global power consumption and emission per clock, with the average usage of the servers.
+    '''
+    insights = aggregates[SUM_COLUMNS].copy()
+    for col in MEAN_COLUMNS:
+        insights[col] = aggregates[col] / aggregates[f'count_{col}']
+
+    return insights
+
+
+@instrumented()
+def stream_emissions(cockpit, zabbix, item_info, chunks, output_path=None):
+    '''
+    Input :
+            - cockpit    : Dataframe
+            - zabbix     : Dataframe
+            - item_info  : Dataframe
+            - chunks     : iterable of item_trend Dataframes (ex: storage.iter_months). The cpu and mem rows
+                           of a server on a given day must be in the same chunk, as in a month of the store.
+            - output_path: csv where the power consumption and emission per server per day are written
+                           chunk by chunk (None : not written)
+
+    Output : Running aggregates per clock and per server (see clock_aggregates), computed chunk by chunk :
+             only one chunk of item_trend is in memory at a time.
+    '''
+    dimensions = dimension_table(cockpit, zabbix, item_info)
+
+    aggregates_clock, aggregates_server = None, None
+    n_rows = 0
+    for chunk in chunks:
+        with stage("server_emissions", len(chunk)) as record:
+            final = server_emissions(join_trend(dimensions, chunk))
+            record["rows_out"] = len(final)
+
+        if output_path is not None:
+            final.index += n_rows
+            final.to_csv(output_path, mode='w' if n_rows == 0 else 'a', header=n_rows == 0)
+        n_rows += len(final)
+
+        aggregates_clock = add_aggregates(aggregates_clock, clock_aggregates(final))
+        aggregates_server = add_aggregates(aggregates_server, clock_aggregates(final, by='name_server'))
+
+    return aggregates_clock, aggregates_server
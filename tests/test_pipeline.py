@@ -0,0 +1,67 @@
+import os
+
+import pandas as pd
+import pytest
+
+from src.pipeline import run_pipeline, export
+from src.synthetic import synthetic_fleet, write_fleet
+
+
+@pytest.fixture
+def fleet(tmp_path):
+    tables = synthetic_fleet(n_servers=40, n_days=150, seed=1)
+    tables.pop("itemid_and_periods")
+    return tables, write_fleet(tables, tmp_path / "data")
+
+
+def test_rewritten_item_trend_is_reloaded(fleet, tmp_path):
+    # a new extraction written to the same csv : the store is rebuilt and the stages read the new items
+    tables, paths = fleet
+    cache_dir = str(tmp_path / "cache")
+    artifacts, _ = run_pipeline(paths, ["periodicity"], cache_dir=cache_dir, max_workers=1)
+    assert artifacts["periodicity"]["periods"].itemid.nunique() > 20
+
+    item_trend = tables["item_trend"]
+    kept = item_trend.itemid.drop_duplicates().iloc[:20]
+    item_trend[item_trend.itemid.isin(kept)].to_csv(paths["item_trend"])
+
+    artifacts, status = run_pipeline(paths, ["periodicity"], cache_dir=cache_dir, max_workers=1)
+    assert status["periodicity"] == "computed"
+    assert set(artifacts["periodicity"]["periods"].itemid) <= set(kept)
+
+
+def test_emissions_per_server_per_day(fleet, tmp_path):
+    _, paths = fleet
+    artifacts, _ = run_pipeline(paths, ["emissions"], cache_dir=str(tmp_path / "cache"), max_workers=1, chunksize=1000)
+
+    written = export(artifacts, str(tmp_path / "results"))
+    server_day = pd.read_csv(tmp_path / "results" / "emissions_server_day.csv")
+    assert str(tmp_path / "results" / "emissions_server_day.csv") in written
+    assert server_day.name_server.nunique() == len(artifacts["emissions"]["aggregates_server"])
+    assert server_day["Global emission"].sum() == pytest.approx(artifacts["emissions"]["global_insights"]["Global emission"].sum())
+
+
+def test_sizing_joins_zabbix_hosts_in_uppercase(fleet, tmp_path):
+    # the zabbix hosts of the extraction are lowercase, the cockpit server names uppercase
+    _, paths = fleet
+    params = {"cleaning": {"engine": "harmonic"}}
+    artifacts, _ = run_pipeline(paths, ["sizing"], params, cache_dir=str(tmp_path / "cache"), max_workers=1)
+    assert len(artifacts["sizing"]["global"])
+
+
+def test_unmatched_zabbix_hosts_raise(fleet, tmp_path):
+    tables, paths = fleet
+    tables["tmp_hosts_zabbix"].assign(host="unknown").to_csv(paths["tmp_hosts_zabbix"])
+    with pytest.raises(ValueError, match="No server of cockpit"):
+        run_pipeline(paths, ["sizing"], {"cleaning": {"engine": "harmonic"}}, cache_dir=str(tmp_path / "cache"), max_workers=1)
+
+
+def test_touched_table_stays_cached(fleet, tmp_path):
+    # the tables are keyed on their content : a touch or a copy of the same extraction is not a change
+    _, paths = fleet
+    cache_dir = str(tmp_path / "cache")
+    run_pipeline(paths, ["periodicity"], cache_dir=cache_dir, max_workers=1)
+
+    os.utime(paths["item_trend"], ns=(0, os.stat(paths["item_trend"]).st_mtime_ns + 10 ** 9))
+    _, status = run_pipeline(paths, ["periodicity"], cache_dir=cache_dir, max_workers=1)
+    assert status["periodicity"] == "cached"
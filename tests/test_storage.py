@@ -0,0 +1,25 @@
+import os
+
+import pytest
+
+from src.storage import build_store, load_table
+
+
+def test_chunked_store_promotes_integers_with_missing_values(tmp_path):
+    # hostid parses as integers in the first chunk, and has a missing value in the second one
+    csv_path = tmp_path / "item_info.csv"
+    csv_path.write_text("itemid,hostid,clock\n1,1,2022-01-01\n2,2,2022-01-02\n3,,2022-02-01\n4,4,2022-02-02\n")
+
+    df = load_table(build_store(str(csv_path), chunksize=2))
+    assert df.hostid.dtype == "float64"
+    assert df.hostid.isna().sum() == 1
+    assert df.itemid.tolist() == [1, 2, 3, 4]
+
+
+def test_failed_build_leaves_no_store(tmp_path):
+    csv_path = tmp_path / "item_trend.csv"
+    csv_path.write_text("itemid,clock\n1,2022-01-01\n2,not a date\n")
+
+    with pytest.raises(ValueError):
+        build_store(str(csv_path), chunksize=1)
+    assert os.listdir(tmp_path) == ["item_trend.csv"]
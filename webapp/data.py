@@ -0,0 +1,154 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from src.storage import load_table
+
+
+# Tables loaded by the pages, shared by all the sessions of the process
+_TABLES = dict()
+_LOCK = threading.Lock()
+
+
+class CachedTable:
+    '''
+    Table loaded once, sorted by (key, date) with the row range of each key.
+
+    Selecting the rows of a key is a slice of the sorted table, and selecting a date range
+    (on a table without key) is a binary search, instead of a boolean filter over the whole table.
+    The tables are shared between the page runs : they must not be modified in place.
+
+    Args:
+        df : pd.DataFrame = loaded table
+        key_column : str = column of the row ranges, ex: name_server (default : no ranges)
+        date_column : str = date column (the table is sorted by date within each key)
+    '''
+    def __init__(self, df, key_column=None, date_column="clock"):
+        self.key_order = list(pd.unique(df[key_column])) if key_column is not None else []
+        sort_columns = [col for col in [key_column, date_column] if col is not None and col in df.columns]
+        self.df = df.sort_values(sort_columns, kind="stable", ignore_index=True) if sort_columns else df
+        self.key_column = key_column
+        self.date_column = date_column
+
+        self.ranges = dict()
+        if key_column is not None:
+            keys = self.df[key_column].to_numpy()
+            starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.array([], dtype=int)
+            stops = np.r_[starts[1:], len(keys)]
+            self.ranges = {keys[start]: (start, stop) for start, stop in zip(starts, stops)}
+
+    def keys(self):
+        '''
+        Keys of the table, in their order of appearance in the loaded table.
+        '''
+        return self.key_order
+
+    def rows(self, key):
+        '''
+        Rows of one key (empty table if the key is unknown).
+        '''
+        start, stop = self.ranges.get(key, (0, 0))
+        return self.df.iloc[start:stop]
+
+    def between(self, start_date=None, end_date=None):
+        '''
+        Rows between two dates, included (table without key only, sorted by date).
+        '''
+        dates = self.df[self.date_column]
+        start = 0 if start_date is None else dates.searchsorted(pd.Timestamp(start_date), side="left")
+        stop = len(dates) if end_date is None else dates.searchsorted(pd.Timestamp(end_date), side="right")
+        return self.df.iloc[start:stop]
+
+
+class TimePyramid:
+    '''
+    Daily, weekly and monthly pre-aggregates of daily series, with their cumulative sums.
+
+    The total of a column over any date range is a difference of two cumulative sums, and
+    a date range is plotted at the finest resolution keeping the number of points bounded.
+    Each level holds the average daily value of each period, so all the levels share the same unit.
+
+    Args:
+        df : pd.DataFrame = table of the daily series
+        columns : list(str) = columns of the series
+        date_column : str = date column (one row per date)
+    '''
+    RESOLUTIONS = {"daily": "D", "weekly": "W", "monthly": "M"}
+
+    def __init__(self, df, columns, date_column="clock"):
+        daily = df.groupby(date_column)[columns].mean().sort_index().astype(float)
+        self.levels = {name: daily.resample(rule).mean().dropna(how="all") for name, rule in self.RESOLUTIONS.items()}
+
+        self.dates = daily.index
+        self.cumsum = pd.DataFrame(np.vstack([np.zeros(len(columns)), daily.fillna(0).cumsum().to_numpy()]),
+            columns=columns)
+
+    def totals(self, start_date=None, end_date=None):
+        '''
+        Sum of each column between two dates, included.
+        '''
+        start = 0 if start_date is None else self.dates.searchsorted(pd.Timestamp(start_date), side="left")
+        stop = len(self.dates) if end_date is None else self.dates.searchsorted(pd.Timestamp(end_date), side="right")
+        return self.cumsum.iloc[max(stop, start)] - self.cumsum.iloc[start]
+
+    def series(self, start_date=None, end_date=None, max_points=400):
+        '''
+        Series between two dates, at the finest resolution with at most max_points points (or the coarsest one).
+
+        Output:
+            series : pd.DataFrame = average daily value of each period, indexed by period
+            resolution : str = resolution of the series (daily, weekly or monthly)
+        '''
+        for resolution, level in self.levels.items():
+            series = level.loc[start_date:end_date]
+            if len(series) <= max_points:
+                break
+        return series, resolution
+
+
+def _cached(path, cache_key, build):
+    # build the cached object of a file, once per process and file modification
+    cache_key = (os.path.abspath(path),) + cache_key
+    mtime = os.path.getmtime(path)
+
+    with _LOCK:
+        cached = _TABLES.get(cache_key)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, build())
+            _TABLES[cache_key] = cached
+
+    return cached[1]
+
+
+def cached_table(path, key_column=None, date_column="clock", **load_kwargs):
+    '''
+    Load a table once per process (see src.storage.load_table), reloaded when the file changes.
+
+    Args:
+        path : str = path of the table
+        key_column : str = column of the row ranges, ex: name_server (default : no ranges)
+        date_column : str = date column of the table
+        load_kwargs : dict = extra arguments passed to load_table
+    Output:
+        table : CachedTable = loaded table
+    '''
+    return _cached(path, ("table", key_column, date_column, repr(sorted(load_kwargs.items()))),
+        lambda: CachedTable(load_table(path, date_column=date_column, **load_kwargs), key_column, date_column))
+
+
+def cached_pyramid(path, columns, date_column="clock", **load_kwargs):
+    '''
+    Build the time pyramid of a table once per process, rebuilt when the file changes.
+
+    Args:
+        path : str = path of the table of the daily series
+        columns : list(str) = columns of the series
+        date_column : str = date column of the table
+        load_kwargs : dict = extra arguments passed to load_table
+    Output:
+        pyramid : TimePyramid = pre-aggregated series
+    '''
+    return _cached(path, ("pyramid", tuple(columns), date_column, repr(sorted(load_kwargs.items()))),
+        lambda: TimePyramid(load_table(path, date_column=date_column, **load_kwargs), list(columns), date_column))
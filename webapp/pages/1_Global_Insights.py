@@ -1,10 +1,14 @@
 import streamlit as st 
-import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 import random
 import datetime
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from webapp.data import cached_table, cached_pyramid
 
 st.set_page_config(layout="wide", page_title="Global Insights", page_icon=":satellite:")
 
@@ -25,26 +29,25 @@ st.text("")
 st.text("")
 
 
-df = pd.read_csv('./data/Global Insights.csv')
-df1 = pd.read_csv('./data/server_list.csv')
-
-df['clock'] = pd.to_datetime(df['clock'])
-df1['clock'] = pd.to_datetime(df1['clock'])
-
 starting_date = datetime.datetime.combine(starting_date, datetime.time.min)
 end_date = datetime.datetime.combine(end_date, datetime.time.min)
-df = df[(df.clock >= starting_date) & (df.clock <= end_date)]
-df1 = df1[(df1.clock >= starting_date) & (df1.clock <= end_date)]
+
+columns = ['value_min', 'value_avg', 'value_max', 'Total Power consumption', 'Global emission',
+           'power_consumption_cpu', 'emission_cpu', 'power_consumption_ram', 'emission_ram']
+pyramid = cached_pyramid('./data/Global Insights.csv', columns, compact=True)
+df1 = cached_table('./data/server_list.csv', compact=True).between(starting_date, end_date)
+
+# totals of the date range, and series at a resolution keeping the plots light
+totals = pyramid.totals(starting_date, end_date)
+series, resolution = pyramid.series(starting_date, end_date)
 
 
 sns.set_palette('rocket')
 
-graph1 = df[['clock', 'value_min', 'value_avg', 'value_max']]
-graph1 = graph1.set_index('clock')
+graph1 = series[['value_min', 'value_avg', 'value_max']]
 
-graph2 = df[['clock','Total Power consumption', 'Global emission']]
-graph2['Total Power consumption'] = graph2['Total Power consumption'] / 1e6
-graph2 = graph2.set_index('clock')
+graph2 = series[['Total Power consumption', 'Global emission']]
+graph2 = graph2.assign(**{'Total Power consumption': graph2['Total Power consumption'] / 1e6})
 
 
 title = '<p style="font-size: 42px; text-align: center;">Overview of Natixis IT Infrastructure</p>'
@@ -80,9 +83,9 @@ with c2:
 
     sns.lineplot(data=graph1)
 
-    ax0.set_xlabel('Time')
+    ax0.set_xlabel(f'Time ({resolution} average)')
     ax0.set_ylabel('% of Use')  
-    plt.xticks(graph1.index[::50], rotation=30) 
+    plt.xticks(graph1.index[::max(1, len(graph1) // 12)], rotation=30) 
     st.pyplot(fig)
 
 
@@ -96,27 +99,27 @@ c1, c2, c3 = st.columns(3)
 
 with c1:
     c1.metric(  "Global Power Consumption (GWh)", 
-    value=round(df['Total Power consumption'].sum() / 10e6, 2))
+    value=round(totals['Total Power consumption'] / 10e6, 2))
     st.text("")
     st.text("")
     c1.metric(  "Global GHG Emission (TeqCO2)", 
-    value=round(df['Global emission'].sum(), 2))
+    value=round(totals['Global emission'], 2))
 
 with c2:
     c2.metric(  "CPUs Power Consumption (GWh)", 
-    value=round(df['power_consumption_cpu'].sum() / 10e6, 2))
+    value=round(totals['power_consumption_cpu'] / 10e6, 2))
     st.text("")
     st.text("")
     c2.metric(  "CPUs GHG Emission (TeqCO2)", 
-    value=round(df['emission_cpu'].sum(), 2))
+    value=round(totals['emission_cpu'], 2))
 
 with c3: 
     c3.metric(  "Memory Power Consumption (GWh)", 
-    value=round(df['power_consumption_ram'].sum() / 10e6, 2))
+    value=round(totals['power_consumption_ram'] / 10e6, 2))
     st.text("")
     st.text("")
     c3.metric(  "Memory GHG Emission (TeqCO2)", 
-    value=round(df['emission_ram'].sum(), 2))
+    value=round(totals['emission_ram'], 2))
 
 st.text("")
 st.text("")
@@ -135,11 +138,11 @@ with c2:
     sns.lineplot(data=graph2, x=graph2.index, y='Total Power consumption', ax=ax)
     sns.lineplot(data=graph2, x=graph2.index, y='Global emission', ax=ax2)
 
-    ax.set_xlabel('Time')
+    ax.set_xlabel(f'Time ({resolution} average)')
     ax.set_ylabel('Total Power Consumption (GWh)')
     ax2.set_ylabel('Global GHG Emission (TeqCO2)')
 
-    plt.xticks(graph2.index[::110], rotation=30)
+    plt.xticks(graph2.index[::max(1, len(graph2) // 6)], rotation=30)
 
     st.pyplot(fig)
 
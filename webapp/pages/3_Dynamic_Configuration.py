@@ -5,6 +5,11 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import random
 import datetime
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from webapp.data import cached_table
  
 
 st.set_page_config(layout="wide", page_title="Server Configuration", page_icon=":satellite:")
@@ -18,13 +23,11 @@ st.sidebar.info(
 
 st.title('Server Configuration')
 
-df = pd.read_csv('./data/global_scenarios.csv', delimiter=';')
-periodic = pd.read_csv('./data/periodic_scenarios.csv')
-
-periodic['ds'] = pd.to_datetime(periodic['ds'], format='%Y-%m-%d').dt.date
+scenarios = cached_table('./data/global_scenarios.csv', key_column='name_server', delimiter=';')
+periodic = cached_table('./data/periodic_scenarios.csv', key_column='name_server', date_column='ds', compact=True)
 
-server = st.selectbox('Choose a specific server to analyze:', df.name_server.unique())
-df_server = df[df['name_server'] == server]
+server = st.selectbox('Choose a specific server to analyze:', scenarios.keys())
+df_server = scenarios.rows(server)
 
 old_cpu = df_server.number_cpu.unique()[0]
 old_ram = int(df_server.ram.unique()[0] / 1_000)
@@ -73,7 +76,8 @@ if df_server.season.unique()[0] == 1.0:
     c1, c2, c3 = st.columns([1, 3, 1])
     
     with c2:
-        temp = periodic[periodic.name_server == server][['ds', 'item_type', 'new_cpu_optim', 'new_ram_optim']]
+        temp = periodic.rows(server)[['ds', 'item_type', 'new_cpu_optim', 'new_ram_optim']]
+        temp = temp.assign(ds=temp['ds'].dt.date)
 
         for item in  temp.item_type.unique():
 